@@ -0,0 +1,333 @@
+"""
+Benchmarks of HTTP2Server against Tornado's HTTP/1.1 HTTPServer.
+
+Every workload runs against a server in a child process, started afresh
+for each protocol, serving the same Application either over HTTP/2
+through HTTP2Server or over HTTP/1.1 through Tornado's HTTPServer, with
+and without TLS. The clients run in this process.
+
+For each run it reports the requests per second, the 50th and 99th
+percentiles of the latency, the bytes per second sent and received, and
+the CPU time of the server per request.
+
+HTTP/1.1 can't multiplex requests, so a connection is opened for every
+request in flight instead, as browsers do.
+
+    python benchmarks/h2_benchmark.py
+    python benchmarks/h2_benchmark.py --workloads=small,static --tls=off
+
+"""
+
+import collections
+import multiprocessing
+import os
+import shutil
+import signal
+import ssl
+import sys
+import tempfile
+import time
+
+from tornado import gen
+from tornado import ioloop
+from tornado import netutil
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.options import options
+
+import tornado_h2.http2server as th2
+from tornado_h2.http2_web import HTTP2StaticFileHandler
+
+from http_clients import (
+    H2ClientConnection, HTTP1ClientConnection, create_client_ssl_context)
+
+try:
+    import PIL
+except ImportError:
+    PIL = None
+
+EXAMPLES_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'examples')
+
+options.define(
+    'workloads', default=['small', 'connections', 'static', 'upload', 'tiles'],
+    help='Workloads to run', type=str, multiple=True)
+options.define(
+    'protocols', default=['h2', 'http1'],
+    help='Protocols to run the workloads with, h2 and/or http1', type=str,
+    multiple=True)
+options.define(
+    'tls', default=['off', 'on'],
+    help='Run the workloads without and/or with TLS', type=str,
+    multiple=True)
+options.define(
+    'scale', default=1.0,
+    help='Factor applied to the number of requests of every workload',
+    type=float)
+options.define(
+    'static_size', default=8 * 1024 * 1024,
+    help='Size in bytes of the file of the static workload', type=int)
+options.define(
+    'upload_size', default=1024 * 1024,
+    help='Size in bytes of the bodies of the upload workload', type=int)
+
+
+#: `connections` opened with `concurrency` requests in flight on each,
+#: `request` is called with the request number and returns the method,
+#: path and body of the request
+Workload = collections.namedtuple(
+    'Workload', ('name', 'requests', 'connections', 'concurrency', 'request'))
+
+WORKLOADS = collections.OrderedDict((workload.name, workload) for workload in (
+    # Many small requests multiplexed on a single connection
+    Workload('small', 10000, 1, 100, lambda i: ('GET', '/', None)),
+    # Many connections with one request at a time each
+    Workload('connections', 5000, 50, 1, lambda i: ('GET', '/', None)),
+    # Large downloads through HTTP2StaticFileHandler
+    Workload('static', 40, 1, 4,
+             lambda i: ('GET', '/static/large.bin', None)),
+    # Request bodies streamed to the server
+    Workload('upload', 200, 1, 8,
+             lambda i: ('POST', '/upload', _upload_body)),
+    # The image tiles of the example app, CPU bound in the handlers
+    Workload('tiles', 2000, 1, 64,
+             lambda i: ('GET', '/tile/{}'.format(i % 64), None)),
+))
+
+_upload_body = None
+
+
+class HelloHandler(web.RequestHandler):
+
+    def get(self):
+        self.write('<h1>Hello HTTP/2!!</h1>')
+
+    def compute_etag(self):
+        return None
+
+
+@web.stream_request_body
+class UploadHandler(web.RequestHandler):
+    """Counts the bytes of the request body without keeping them.
+
+    """
+
+    def prepare(self):
+        self.size = 0
+
+    def data_received(self, chunk):
+        self.size += len(chunk)
+
+    def post(self):
+        self.write(str(self.size))
+
+
+def make_application(static_path):
+    handlers = [
+        (r'/', HelloHandler),
+        (r'/upload', UploadHandler),
+        (r'/static/(.*)', HTTP2StaticFileHandler, {'path': static_path}),
+    ]
+    if PIL is not None:
+        # Only imported when needed as it defines its own options
+        sys.path.insert(0, EXAMPLES_PATH)
+        import tornado_h2_python_tiles as tiles
+        tiles.img = tiles.load_image(
+            os.path.join(EXAMPLES_PATH, 'static', 'burmese_python.jpg'))
+        handlers.append((r'/tile/(\d+)', tiles.TileHandler, {}, 'tile'))
+    return web.Application(handlers)
+
+
+def create_server_ssl_context(protocol):
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(
+        certfile=os.path.join(EXAMPLES_PATH, 'server.crt'),
+        keyfile=os.path.join(EXAMPLES_PATH, 'server.key'))
+    ssl_context.set_alpn_protocols([protocol])
+    return ssl_context
+
+
+def serve(protocol, tls, static_path, pipe):
+    """Runs the server of a benchmark in a child process.
+
+    Sends the port it listens on through `pipe`, then its CPU time on
+    every SIGUSR1 until stopped by SIGTERM.
+
+    """
+    io_loop = ioloop.IOLoop()
+    io_loop.make_current()
+    application = make_application(static_path)
+    if protocol == 'h2':
+        ssl_options = create_server_ssl_context('h2') if tls else None
+        server = th2.HTTP2Server(application, ssl_options=ssl_options)
+    else:
+        ssl_options = create_server_ssl_context('http/1.1') if tls else None
+        server = HTTPServer(application, ssl_options=ssl_options)
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    server.add_sockets(sockets)
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: (
+        io_loop.add_callback_from_signal(pipe.send, time.process_time())))
+    signal.signal(signal.SIGTERM, lambda signum, frame: (
+        io_loop.add_callback_from_signal(io_loop.stop)))
+    pipe.send(sockets[0].getsockname()[1])
+    io_loop.start()
+
+
+class BenchmarkServer(object):
+    """A server process for the benchmarks of a protocol.
+
+    """
+
+    def __init__(self, protocol, tls, static_path):
+        self._pipe, child_pipe = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=serve, args=(protocol, tls, static_path, child_pipe))
+        self._process.start()
+        self.port = self._pipe.recv()
+
+    def cpu_time(self):
+        os.kill(self._process.pid, signal.SIGUSR1)
+        return self._pipe.recv()
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@gen.coroutine
+def run_requests(workload, connection_class, ssl_options, port, requests,
+                 connections, concurrency):
+    """Sends `requests` requests of `workload`, returns their responses
+    and the number that failed.
+
+    """
+    clients = yield [
+        connection_class.connect('127.0.0.1', port, ssl_options=ssl_options)
+        for _ in range(connections)]
+    numbers = iter(range(requests))
+    responses = []
+    errors = [0]
+
+    @gen.coroutine
+    def worker(client):
+        for number in numbers:
+            method, path, body = workload.request(number)
+            try:
+                response = yield client.request(method, path, body)
+            except Exception:
+                errors[0] += 1
+            else:
+                responses.append(response)
+
+    try:
+        yield [
+            worker(client) for client in clients for _ in range(concurrency)]
+    finally:
+        for client in clients:
+            client.close()
+    raise gen.Return((responses, errors[0]))
+
+
+def run_benchmark(workload, protocol, tls, static_path):
+    """Runs `workload` against a new server, returns a dict with the
+    results.
+
+    """
+    connection_class = (
+        H2ClientConnection if protocol == 'h2' else HTTP1ClientConnection)
+    ssl_options = (
+        create_client_ssl_context(connection_class.protocol) if tls else None)
+    connections, concurrency = workload.connections, workload.concurrency
+    if protocol != 'h2':
+        connections, concurrency = connections * concurrency, 1
+    requests = max(1, int(workload.requests * options.scale))
+
+    server = BenchmarkServer(protocol, tls, static_path)
+    io_loop = ioloop.IOLoop.current()
+    try:
+        # Warm up the server's caches and the connections' windows
+        io_loop.run_sync(lambda: run_requests(
+            workload, connection_class, ssl_options, server.port,
+            max(1, requests // 10), connections, concurrency))
+
+        start_cpu = server.cpu_time()
+        start_time = time.time()
+        responses, errors = io_loop.run_sync(lambda: run_requests(
+            workload, connection_class, ssl_options, server.port, requests,
+            connections, concurrency))
+        elapsed = time.time() - start_time
+        cpu = server.cpu_time() - start_cpu
+    finally:
+        server.stop()
+
+    latencies = sorted(response.latency for response in responses)
+    request_body = workload.request(0)[2] or b''
+    size = sum(response.size for response in responses)
+    size += len(request_body) * len(responses)
+    errors += sum(response.status != 200 for response in responses)
+    return {
+        'requests': requests,
+        'requests_per_second': requests / elapsed,
+        'p50': percentile(latencies, 0.5) if latencies else 0,
+        'p99': percentile(latencies, 0.99) if latencies else 0,
+        'bytes_per_second': size / elapsed,
+        'cpu_per_request': cpu / requests,
+        'errors': errors,
+    }
+
+
+def main():
+    global _upload_body
+    # Keep the access log quiet unless asked otherwise
+    options.logging = 'warning'
+    options.parse_command_line()
+    _upload_body = b'x' * options.upload_size
+
+    workloads = []
+    for name in options.workloads:
+        if name not in WORKLOADS:
+            raise SystemExit('Unknown workload {}, choose from {}'.format(
+                name, ', '.join(WORKLOADS)))
+        if name == 'tiles' and PIL is None:
+            print('Skipping tiles, Pillow is not installed')
+            continue
+        workloads.append(WORKLOADS[name])
+
+    static_path = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(static_path, 'large.bin'), 'wb') as f:
+            f.write(os.urandom(options.static_size))
+
+        print('{:<12} {:<9} {:<4} {:>9} {:>9} {:>8} {:>8} {:>9} {:>11} '
+              '{:>7}'.format(
+                  'workload', 'protocol', 'tls', 'requests', 'req/s',
+                  'p50 ms', 'p99 ms', 'MB/s', 'CPU us/req', 'errors'))
+        for workload in workloads:
+            for tls in options.tls:
+                for protocol in options.protocols:
+                    result = run_benchmark(
+                        workload, protocol, tls == 'on', static_path)
+                    print('{:<12} {:<9} {:<4} {requests:>9} '
+                          '{requests_per_second:>9.0f} {p50:>8.2f} '
+                          '{p99:>8.2f} {bytes_per_second:>9.1f} '
+                          '{cpu_per_request:>11.0f} {errors:>7}'.format(
+                              workload.name, protocol, tls,
+                              **dict(result,
+                                     p50=result['p50'] * 1e3,
+                                     p99=result['p99'] * 1e3,
+                                     bytes_per_second=(
+                                         result['bytes_per_second'] / 1e6),
+                                     cpu_per_request=(
+                                         result['cpu_per_request'] * 1e6))))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(static_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+Minimal asynchronous HTTP/2 and HTTP/1.1 clients driving the benchmarks.
+
+They only do what the benchmarks need, keeping their own overhead low so
+that the measurements reflect the server.
+
+"""
+
+import collections
+import ssl
+import time
+
+from tornado import gen
+from tornado import httputil
+from tornado import iostream
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.tcpclient import TCPClient
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.settings import SettingCodes
+import h2.events
+
+
+#: Status, size of the body and seconds since the request was sent
+Response = collections.namedtuple('Response', ('status', 'size', 'latency'))
+
+# Windows large enough for the client never to throttle downloads
+_WINDOW_SIZE = 2 ** 24
+
+
+class ResponseError(Exception):
+    pass
+
+
+def create_client_ssl_context(protocol):
+    """Returns an SSL context trusting any certificate and offering
+    `protocol` through ALPN.
+
+    """
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    ssl_context.set_alpn_protocols([protocol])
+    return ssl_context
+
+
+class _Exchange(object):
+
+    __slots__ = ('future', 'start_time', 'status', 'size')
+
+    def __init__(self, future):
+        self.future = future
+        self.start_time = time.time()
+        self.status = None
+        self.size = 0
+
+
+class H2ClientConnection(object):
+    """HTTP/2 client connection multiplexing any number of requests.
+
+    """
+
+    protocol = 'h2'
+
+    def __init__(self, stream, authority, scheme):
+        self.stream = stream
+        self.authority = authority
+        self.scheme = scheme
+        config = H2Configuration(client_side=True, header_encoding='utf-8')
+        self.conn = H2Connection(config)
+        self._exchanges = {}
+        # Request bodies waiting for the flow control window by stream_id,
+        # as a memoryview and the offset sent so far
+        self._uploads = collections.OrderedDict()
+
+    @classmethod
+    @gen.coroutine
+    def connect(cls, host, port, ssl_options=None):
+        stream = yield TCPClient().connect(host, port, ssl_options=ssl_options)
+        stream.set_nodelay(True)
+        connection = cls(
+            stream, '{}:{}'.format(host, port),
+            'http' if ssl_options is None else 'https')
+        connection.conn.initiate_connection()
+        connection.conn.update_settings(
+            {SettingCodes.INITIAL_WINDOW_SIZE: _WINDOW_SIZE})
+        connection.conn.increment_flow_control_window(_WINDOW_SIZE)
+        connection._flush()
+        IOLoop.current().spawn_callback(connection._read_loop)
+        raise gen.Return(connection)
+
+    def request(self, method, path, body=None):
+        """Sends a request, returns a Future resolved with its `Response`.
+
+        """
+        future = Future()
+        stream_id = self.conn.get_next_available_stream_id()
+        headers = [
+            (':method', method),
+            (':path', path),
+            (':scheme', self.scheme),
+            (':authority', self.authority),
+        ]
+        if body:
+            headers.append(('content-length', str(len(body))))
+        self._exchanges[stream_id] = _Exchange(future)
+        self.conn.send_headers(stream_id, headers, end_stream=not body)
+        if body:
+            self._uploads[stream_id] = [memoryview(body), 0]
+            self._send_uploads()
+        self._flush()
+        return future
+
+    def close(self):
+        self.stream.close()
+
+    def _send_uploads(self):
+        for stream_id, upload in list(self._uploads.items()):
+            view, offset = upload
+            while offset < len(view):
+                size = min(
+                    len(view) - offset,
+                    self.conn.local_flow_control_window(stream_id),
+                    self.conn.max_outbound_frame_size)
+                if size <= 0:
+                    break
+                self.conn.send_data(
+                    stream_id, view[offset:offset + size],
+                    end_stream=offset + size == len(view))
+                offset += size
+            upload[1] = offset
+            if offset == len(view):
+                del self._uploads[stream_id]
+
+    def _flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.stream.write(data)
+
+    @gen.coroutine
+    def _read_loop(self):
+        try:
+            while True:
+                data = yield self.stream.read_bytes(65535, partial=True)
+                for event in self.conn.receive_data(data):
+                    self._handle_event(event)
+                if self._uploads:
+                    self._send_uploads()
+                self._flush()
+        except iostream.StreamClosedError:
+            self._fail_all(ResponseError('Connection closed'))
+
+    def _handle_event(self, event):
+        if isinstance(event, h2.events.DataReceived):
+            self._exchanges[event.stream_id].size += len(event.data)
+            self.conn.acknowledge_received_data(
+                event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.ResponseReceived):
+            self._exchanges[event.stream_id].status = int(
+                dict(event.headers)[':status'])
+        elif isinstance(event, h2.events.StreamEnded):
+            exchange = self._exchanges.pop(event.stream_id)
+            exchange.future.set_result(Response(
+                exchange.status, exchange.size,
+                time.time() - exchange.start_time))
+        elif isinstance(event, h2.events.StreamReset):
+            self._uploads.pop(event.stream_id, None)
+            exchange = self._exchanges.pop(event.stream_id, None)
+            if exchange is not None:
+                exchange.future.set_exception(ResponseError(
+                    'Stream reset with {}'.format(event.error_code)))
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self._fail_all(ResponseError('Connection terminated'))
+
+    def _fail_all(self, error):
+        exchanges, self._exchanges = self._exchanges, {}
+        for exchange in exchanges.values():
+            exchange.future.set_exception(error)
+
+
+class HTTP1ClientConnection(object):
+    """HTTP/1.1 keep-alive client connection, one request at a time.
+
+    """
+
+    protocol = 'http/1.1'
+
+    def __init__(self, stream, authority):
+        self.stream = stream
+        self.authority = authority
+
+    @classmethod
+    @gen.coroutine
+    def connect(cls, host, port, ssl_options=None):
+        stream = yield TCPClient().connect(host, port, ssl_options=ssl_options)
+        stream.set_nodelay(True)
+        raise gen.Return(cls(stream, '{}:{}'.format(host, port)))
+
+    @gen.coroutine
+    def request(self, method, path, body=None):
+        """Sends a request, returns a Future resolved with its `Response`.
+
+        """
+        start_time = time.time()
+        lines = [
+            '{} {} HTTP/1.1'.format(method, path),
+            'Host: {}'.format(self.authority),
+        ]
+        if body:
+            lines.append('Content-Length: {}'.format(len(body)))
+        self.stream.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+        if body:
+            self.stream.write(body)
+
+        data = yield self.stream.read_until(b'\r\n\r\n', max_bytes=65536)
+        start_line, _, header_lines = data.decode('latin1').partition('\r\n')
+        start_line = httputil.parse_response_start_line(start_line)
+        headers = httputil.HTTPHeaders.parse(header_lines)
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            size = yield self._read_chunked_body()
+        else:
+            size = int(headers.get('Content-Length', 0))
+            if size:
+                yield self.stream.read_bytes(size)
+        raise gen.Return(
+            Response(start_line.code, size, time.time() - start_time))
+
+    def close(self):
+        self.stream.close()
+
+    @gen.coroutine
+    def _read_chunked_body(self):
+        size = 0
+        while True:
+            line = yield self.stream.read_until(b'\r\n', max_bytes=64)
+            chunk_size = int(line.strip(), 16)
+            if chunk_size == 0:
+                yield self.stream.read_until(b'\r\n', max_bytes=64)
+                raise gen.Return(size)
+            yield self.stream.read_bytes(chunk_size + 2)
+            size += chunk_size
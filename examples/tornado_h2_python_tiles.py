@@ -22,6 +22,7 @@ from tornado.options import options
 import log
 import tornado_h2.http2server as th2
 from tornado_h2 import http2_web
+from tornado_h2.http2offload import OffloadMixin, OffloadPool, offloaded
 
 logger = logging.getLogger('tornado.application')
 
@@ -44,6 +45,9 @@ options.define(
 options.define(
     'max_tiles', default=8,
     help="The number of tiles to divide the image, defaults to 8 (8x8)")
+options.define(
+    'push', default=True,
+    help='Push the stylesheet and tiles along with the home page', type=bool)
 
 
 Point = namedtuple('Point', ('x', 'y'))
@@ -53,6 +57,18 @@ class TileOutOfBoundsError(Exception):
     pass
 
 
+def load_image(path):
+    """Opens the image at `path` and decodes it.
+
+    Pillow decodes lazily on the first access to the pixels, which isn't
+    safe from the threads cropping tiles at once.
+
+    """
+    image = Image.open(path)
+    image.load()
+    return image
+
+
 def create_ssl_context(certfile, keyfile):
     ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     ssl_context.options |= (
@@ -60,18 +76,22 @@ def create_ssl_context(certfile, keyfile):
     )
     ssl_context.set_ciphers('ECDHE+AESGCM')
     ssl_context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-    ssl_context.set_alpn_protocols(['h2'])
+    ssl_context.set_alpn_protocols(['h2', 'http/1.1'])
     return ssl_context
 
 
-class TileHandler(tornado.web.RequestHandler):
+class TileHandler(OffloadMixin, tornado.web.RequestHandler):
     """Handler to create tiles for an image `img` in the closure.
 
     GET `tile/N` returns a localised crop of the image as defined by
-    `max_tiles`.
+    `max_tiles`. Tiles are cropped and encoded on a thread pool, Pillow
+    releasing the GIL while it does, so the IOLoop keeps serving the
+    connections meanwhile.
 
     """
 
+    offload_pool = OffloadPool()
+
     def compute_etag(self):
         return None
 
@@ -98,6 +118,18 @@ class TileHandler(tornado.web.RequestHandler):
         )
         return img.crop(crop_box)
 
+    @offloaded
+    def render_tile(self, tile_number):
+        """Returns the JPEG encoding of the tile `tile_number`.
+
+        :raises TileOutOfBoundsError: When `tile_number` exceeds `max_tiles`^2
+        :rtype bytes:
+
+        """
+        buf = BytesIO()
+        self.get_tile(tile_number).save(buf, 'JPEG')
+        return buf.getvalue()
+
     @tornado.gen.coroutine
     def get(self, tile_number):
         """Handles GET requests for a tile number.
@@ -107,14 +139,10 @@ class TileHandler(tornado.web.RequestHandler):
         """
         # yield tornado.gen.sleep(5)
         try:
-            tile = self.get_tile(tile_number)
+            content = yield self.render_tile(tile_number)
         except TileOutOfBoundsError:
             raise tornado.web.HTTPError(404)
 
-        buf = BytesIO(tile.tobytes())
-        tile.save(buf, 'JPEG')
-
-        content = buf.getvalue()
         self.set_header('Content-Type', 'image/jpg')
         self.set_header('Accept-Ranges', 'bytes')
         self.set_header('Content-Length', len(content))
@@ -124,9 +152,19 @@ class TileHandler(tornado.web.RequestHandler):
 class HomePageHandler(tornado.web.RequestHandler):
     """Simple handler for showing a template with a header and the image tiles.
 
+    If enabled the stylesheet and tiles are pushed to the client before
+    rendering the template, saving the round-trip to request them.
+
     """
 
     def get(self):
+        # Connections on HTTP/1.1 can't push
+        if options.push and hasattr(self.request.connection, 'push'):
+            self.request.connection.push(
+                self.reverse_url('static', 'style.css'))
+            for tile_number in range(options.max_tiles ** 2):
+                self.request.connection.push(
+                    self.reverse_url('tile', tile_number))
         self.render('template.html', max_tiles=options.max_tiles)
 
     def compute_etag(self):
@@ -170,7 +208,7 @@ if __name__ == '__main__':
     base_path = os.path.dirname(__file__)
     options.parse_command_line()
     path_to_image = os.path.join(base_path, 'static', options.image_name)
-    img = Image.open(path_to_image)
+    img = load_image(path_to_image)
     log.setup_logging()
 
     ssl_paths = [
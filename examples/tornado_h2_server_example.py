@@ -20,6 +20,7 @@ from tornado.options import options
 import log
 import tornado_h2.http2server as th2
 from tornado_h2.http2_web import HTTP2StaticFileHandler
+from tornado_h2.http2process import HTTP2Workers
 
 logger = logging.getLogger('tornado.application')
 
@@ -35,6 +36,12 @@ options.define(
 options.define(
     "debug", default=True,
     help="Start application in debug mode?", type=bool)
+options.define(
+    "processes", default=1,
+    help="Number of worker processes, 0 for one per CPU", type=int)
+options.define(
+    "reuse_port", default=False,
+    help="Bind a SO_REUSEPORT socket in each worker process?", type=bool)
 
 
 def create_ssl_context(certfile, keyfile):
@@ -44,7 +51,7 @@ def create_ssl_context(certfile, keyfile):
     )
     ssl_context.set_ciphers("ECDHE+AESGCM")
     ssl_context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-    ssl_context.set_alpn_protocols(["h2"])
+    ssl_context.set_alpn_protocols(["h2", "http/1.1"])
     return ssl_context
 
 
@@ -83,12 +90,23 @@ if __name__ == '__main__':
         os.path.join(base_path, f) for f in ('server.crt', 'server.key')]
     ssl_context = create_ssl_context(*ssl_paths) if options.https else None
 
-    app = HTTP2ExampleApplication()
-    server = th2.HTTP2Server(app, ssl_options=ssl_context)
     logger.info("Starting HTTP2 server on http{}://{}:{}".format(
         "s" if options.https else "", options.address, options.port))
-    server.bind(options.port, address=options.address)
-    server.start()
 
-    io_loop = tornado.ioloop.IOLoop.current()
-    io_loop.start()
+    if options.processes != 1:
+        # Autoreload doesn't work with multiple processes
+        options.debug = False
+        workers = HTTP2Workers(
+            lambda: th2.HTTP2Server(
+                HTTP2ExampleApplication(), ssl_options=ssl_context),
+            options.port, address=options.address,
+            num_processes=options.processes, reuse_port=options.reuse_port)
+        workers.start()
+    else:
+        app = HTTP2ExampleApplication()
+        server = th2.HTTP2Server(app, ssl_options=ssl_context)
+        server.bind(options.port, address=options.address)
+        server.start()
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        io_loop.start()
@@ -0,0 +1,126 @@
+"""
+Minimal HTTP/2 client for the tests, driving an H2Connection over an
+IOStream.
+
+GOAWAY frames are recorded rather than handed to the H2Connection, which
+would close on the first one and reject the responses still coming on a
+connection being drained.
+
+"""
+
+from tornado import gen
+from tornado.tcpclient import TCPClient
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+import h2.events
+from hyperframe.frame import Frame, GoAwayFrame
+
+
+class Response(object):
+    """What was received on a stream.
+
+    """
+
+    def __init__(self):
+        self.headers = None
+        self.data = b''
+        self.ended = False
+        self.reset = None
+
+    @property
+    def status(self):
+        return int(self.headers[':status'])
+
+
+class H2Client(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.conn = H2Connection(H2Configuration(
+            client_side=True, header_encoding='utf-8'))
+        self.conn.initiate_connection()
+        self.responses = {}
+        # (last_stream_id, error_code) of the GOAWAYs received
+        self.goaways = []
+        self._buffer = b''
+
+    @classmethod
+    @gen.coroutine
+    def connect(cls, port):
+        stream = yield TCPClient().connect('127.0.0.1', port)
+        client = cls(stream)
+        yield client.flush()
+        raise gen.Return(client)
+
+    def send_headers(self, method, path, headers=(), end_stream=True):
+        """Opens a stream with a request, returns its id.
+
+        """
+        stream_id = self.conn.get_next_available_stream_id()
+        request_headers = [
+            (':method', method), (':path', path), (':scheme', 'http'),
+            (':authority', 'localhost')]
+        request_headers.extend(headers)
+        self.conn.send_headers(stream_id, request_headers, end_stream)
+        self.responses[stream_id] = Response()
+        return stream_id
+
+    def flush(self):
+        return self.stream.write(self.conn.data_to_send())
+
+    @gen.coroutine
+    def read_until(self, predicate):
+        """Reads and handles frames until `predicate()` is true.
+
+        """
+        while not predicate():
+            data = yield self.stream.read_bytes(65535, partial=True)
+            for event in self.conn.receive_data(self._filter_goaways(data)):
+                self._handle(event)
+            yield self.flush()
+
+    def _filter_goaways(self, data):
+        """Returns the complete frames in `data` and the data buffered
+        before it, minus the GOAWAYs which are recorded in `goaways`.
+
+        """
+        data = self._buffer + data
+        frames = []
+        while len(data) >= 9:
+            frame, length = Frame.parse_frame_header(data[:9])
+            if len(data) < 9 + length:
+                break
+            if isinstance(frame, GoAwayFrame):
+                frame.parse_body(memoryview(data[9:9 + length]))
+                self.goaways.append((frame.last_stream_id, frame.error_code))
+            else:
+                frames.append(data[:9 + length])
+            data = data[9 + length:]
+        self._buffer = data
+        return b''.join(frames)
+
+    @gen.coroutine
+    def fetch(self, method, path, headers=()):
+        stream_id = self.send_headers(method, path, headers)
+        yield self.flush()
+        response = self.responses[stream_id]
+        yield self.read_until(lambda: response.ended)
+        raise gen.Return(response)
+
+    def close(self):
+        self.stream.close()
+
+    def _handle(self, event):
+        response = self.responses.get(getattr(event, 'stream_id', None))
+        if isinstance(event, h2.events.ResponseReceived):
+            response.headers = dict(event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            response.data += event.data
+            self.conn.acknowledge_received_data(
+                event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            response.ended = True
+        elif isinstance(event, h2.events.StreamReset):
+            response.ended = True
+            response.reset = event.error_code
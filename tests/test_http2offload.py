@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+from io import BytesIO
+from unittest import mock
+
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+from tornado import web
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from tornado_h2.http2offload import OffloadPool
+from tornado_h2.http2server import HTTP2Server
+
+from tests.h2client import H2Client
+
+EXAMPLES_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+
+@unittest.skipIf(Image is None, 'Pillow is not installed')
+class TileHandlerTest(AsyncTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        sys.path.insert(0, EXAMPLES_PATH)
+        import tornado_h2_python_tiles as tiles
+        cls.tiles = tiles
+        tiles.img = tiles.load_image(
+            os.path.join(EXAMPLES_PATH, 'static', 'burmese_python.jpg'))
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.remove(EXAMPLES_PATH)
+
+    def setUp(self):
+        super(TileHandlerTest, self).setUp()
+        self.pool = OffloadPool(8)
+        patcher = mock.patch.object(
+            self.tiles.TileHandler, 'offload_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        app = web.Application([(r'/tile/(\d+)', self.tiles.TileHandler)])
+        self.server = HTTP2Server(app)
+        sock, self.port = bind_unused_port()
+        self.server.add_socket(sock)
+
+    def tearDown(self):
+        self.server.stop()
+        self.pool.executor.shutdown()
+        super(TileHandlerTest, self).tearDown()
+
+    @gen_test
+    def test_tiles_rendered_concurrently(self):
+        client = yield H2Client.connect(self.port)
+        stream_ids = [
+            client.send_headers('GET', '/tile/%d' % tile_number)
+            for tile_number in range(32)]
+        yield client.flush()
+        responses = [client.responses[stream_id] for stream_id in stream_ids]
+        yield client.read_until(
+            lambda: all(response.ended for response in responses))
+        for response in responses:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(Image.open(BytesIO(response.data)).format,
+                             'JPEG')
+        # The tiles were cropped from the same image on several threads
+        self.assertEqual(self.pool.stats()['completed'], 32)
+        self.assertEqual(self.pool.stats()['failed'], 0)
+        client.close()
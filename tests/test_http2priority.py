@@ -0,0 +1,34 @@
+import unittest
+
+from tornado_h2.http2priority import PriorityTree
+
+
+class PriorityTreeTest(unittest.TestCase):
+
+    def test_idle_nodes_are_bounded(self):
+        tree = PriorityTree(max_idle_nodes=2)
+        tree.insert(1)
+        for stream_id in (3, 5, 7):
+            tree.insert(stream_id, depends_on=1, idle=True)
+        self.assertIn(1, tree)
+        self.assertNotIn(3, tree)
+        self.assertIn(5, tree)
+        self.assertIn(7, tree)
+
+    def test_idle_node_opened_is_kept(self):
+        tree = PriorityTree(max_idle_nodes=1)
+        tree.insert(3, depends_on=1)
+        # 1 was created as a placeholder, then opened
+        self.assertEqual(tree.next_stream({1}), 1)
+        tree.insert(5, idle=True)
+        tree.insert(7, idle=True)
+        self.assertIn(1, tree)
+        self.assertNotIn(5, tree)
+        self.assertIn(7, tree)
+
+    def test_evicted_placeholder_children_move_up(self):
+        tree = PriorityTree(max_idle_nodes=1)
+        tree.insert(5, depends_on=3)
+        tree.insert(7, idle=True)
+        self.assertNotIn(3, tree)
+        self.assertEqual(tree.next_stream({5}), 5)
@@ -0,0 +1,604 @@
+import gzip
+import mimetypes
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+import h2.events
+from tornado import gen
+from tornado.httputil import HTTPHeaders
+from tornado.iostream import IOStream
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+from tornado import web
+
+from tornado_h2 import http2server
+from tornado_h2.http2_web import HTTP2StaticFileHandler, StaticContentCache
+from tornado_h2.http2flowcontrol import FlowControlScheduler
+from tornado_h2.http2server import HTTP2Server
+from tornado_h2.http2serverconnection import is_h2c_upgrade
+
+from tests.h2client import H2Client
+
+
+class HelloHandler(web.RequestHandler):
+
+    def get(self):
+        self.write('Hello')
+
+
+class SlowHandler(web.RequestHandler):
+
+    @gen.coroutine
+    def get(self):
+        yield gen.sleep(0.2)
+        self.write('Slow')
+
+
+@web.stream_request_body
+class UploadHandler(web.RequestHandler):
+
+    def prepare(self):
+        self.received = 0
+
+    def data_received(self, chunk):
+        self.received += len(chunk)
+
+    def post(self):
+        self.write(str(self.received))
+
+
+@web.stream_request_body
+class FailingUploadHandler(web.RequestHandler):
+
+    def data_received(self, chunk):
+        raise ValueError('Failed on purpose')
+
+    def put(self):
+        self.write('Uploaded')
+
+
+@web.stream_request_body
+class RejectingUploadHandler(web.RequestHandler):
+
+    closed = 0
+
+    def prepare(self):
+        self.set_status(413)
+        self.finish()
+
+    def data_received(self, chunk):
+        pass
+
+    def on_connection_close(self):
+        RejectingUploadHandler.closed += 1
+
+
+class IsH2cUpgradeTest(unittest.TestCase):
+
+    def headers(self, **kwargs):
+        headers = HTTPHeaders({
+            'Host': 'localhost',
+            'Connection': 'Upgrade, HTTP2-Settings',
+            'Upgrade': 'h2c',
+            # MAX_CONCURRENT_STREAMS = 100
+            'HTTP2-Settings': 'AAMAAABk',
+        })
+        for name, value in kwargs.items():
+            name = name.replace('_', '-')
+            if value is None:
+                del headers[name]
+            else:
+                headers[name] = value
+        return headers
+
+    def test_upgrade(self):
+        self.assertTrue(is_h2c_upgrade(self.headers()))
+        self.assertTrue(is_h2c_upgrade(self.headers(
+            Connection='keep-alive, upgrade,http2-settings')))
+
+    def test_connection_must_list_upgrade_and_settings(self):
+        self.assertFalse(is_h2c_upgrade(self.headers(Connection=None)))
+        self.assertFalse(is_h2c_upgrade(self.headers(Connection='Upgrade')))
+        self.assertFalse(is_h2c_upgrade(self.headers(
+            Connection='HTTP2-Settings')))
+
+    def test_invalid_settings(self):
+        self.assertFalse(is_h2c_upgrade(self.headers(HTTP2_Settings=None)))
+        self.assertFalse(is_h2c_upgrade(self.headers(HTTP2_Settings='AAMA')))
+
+    def test_request_with_body(self):
+        self.assertFalse(is_h2c_upgrade(self.headers(Content_Length='10')))
+
+
+class HTTP2StreamTest(AsyncTestCase):
+
+    def setUp(self):
+        super(HTTP2StreamTest, self).setUp()
+        app = web.Application([
+            (r'/hello', HelloHandler),
+            (r'/upload', UploadHandler),
+            (r'/failing', FailingUploadHandler),
+            (r'/rejecting', RejectingUploadHandler),
+        ])
+        self.server = HTTP2Server(app, max_inflight_requests=2)
+        sock, self.port = bind_unused_port()
+        self.server.add_socket(sock)
+
+    def tearDown(self):
+        self.server.stop()
+        super(HTTP2StreamTest, self).tearDown()
+
+    @gen_test
+    def test_delegate_error_resets_only_its_stream(self):
+        client = yield H2Client.connect(self.port)
+        stream_ids = []
+        for _ in range(2):
+            stream_id = client.send_headers(
+                'PUT', '/failing', end_stream=False)
+            client.conn.send_data(stream_id, b'x' * 100, end_stream=True)
+            stream_ids.append(stream_id)
+        yield client.flush()
+        with self.assertLogs('tornado.application', 'ERROR'):
+            yield client.read_until(lambda: all(
+                client.responses[stream_id].ended
+                for stream_id in stream_ids))
+        for stream_id in stream_ids:
+            # INTERNAL_ERROR
+            self.assertEqual(client.responses[stream_id].reset, 2)
+
+        response = yield client.fetch('GET', '/hello')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.data, b'Hello')
+        self.assertEqual(self.server.stats()['requests_in_flight'], 0)
+        client.close()
+
+    @gen_test
+    def test_response_before_request_body_resets_stream(self):
+        client = yield H2Client.connect(self.port)
+        stream_id = client.send_headers(
+            'PUT', '/rejecting', [('content-length', '1000000')],
+            end_stream=False)
+        client.conn.send_data(stream_id, b'x' * 1000)
+        yield client.flush()
+        response = client.responses[stream_id]
+        yield client.read_until(lambda: response.reset is not None)
+        self.assertEqual(response.status, 413)
+        # NO_ERROR, the client may stop sending the body
+        self.assertEqual(response.reset, 0)
+
+        response = yield client.fetch('GET', '/hello')
+        # The body reader stopped, closing the delegate
+        self.assertEqual(RejectingUploadHandler.closed, 1)
+        self.assertEqual(response.status, 200)
+        server_conn, = self.server._connections
+        self.assertEqual(server_conn.h2_connection.streams, {})
+        self.assertEqual(self.server.stats()['requests_in_flight'], 0)
+        client.close()
+
+    @gen_test
+    def test_uploads_complete_under_exhausted_budget(self):
+        client = yield H2Client.connect(self.port)
+        # The uploads take up the whole budget until their body is received
+        upload_ids = [
+            client.send_headers('POST', '/upload', end_stream=False)
+            for _ in range(2)]
+        refused_id = client.send_headers('GET', '/hello')
+        yield client.flush()
+        refused = client.responses[refused_id]
+        yield client.read_until(lambda: refused.ended)
+        # REFUSED_STREAM
+        self.assertEqual(refused.reset, 7)
+
+        for stream_id in upload_ids:
+            client.conn.send_data(stream_id, b'x' * 1000, end_stream=True)
+        yield client.flush()
+        yield client.read_until(lambda: all(
+            client.responses[stream_id].ended for stream_id in upload_ids))
+        for stream_id in upload_ids:
+            response = client.responses[stream_id]
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.data, b'1000')
+
+        response = yield client.fetch('GET', '/hello')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.server.stats()['requests_refused'], 1)
+        client.close()
+
+    @gen_test
+    def test_priority_flood_is_bounded(self):
+        client = yield H2Client.connect(self.port)
+        response = yield client.fetch('GET', '/hello')
+        for stream_id in range(1001, 41001, 2):
+            # Idle streams depending on idle placeholders, and the closed
+            # stream 1
+            client.conn.prioritize(stream_id, depends_on=stream_id + 2)
+            client.conn.prioritize(1, depends_on=stream_id)
+        yield client.flush()
+
+        response = yield client.fetch('GET', '/hello')
+        self.assertEqual(response.status, 200)
+        server_conn, = self.server._connections
+        flow_control = server_conn.h2_connection.flow_control
+        self.assertNotIn(1, flow_control.priority)
+        self.assertLessEqual(
+            len(flow_control.priority._nodes),
+            flow_control.priority.max_idle_nodes + 1)
+        client.close()
+
+
+class NegotiationTest(AsyncTestCase):
+
+    def setUp(self):
+        super(NegotiationTest, self).setUp()
+        app = web.Application([(r'/hello', HelloHandler)])
+        self.server = HTTP2Server(app)
+        sock, self.port = bind_unused_port()
+        self.server.add_socket(sock)
+
+    def tearDown(self):
+        self.server.stop()
+        super(NegotiationTest, self).tearDown()
+
+    @gen_test
+    def test_stalled_preface_falls_back_to_http1(self):
+        wait_for_data = mock.Mock(wraps=http2server._wait_for_data)
+        with mock.patch.object(http2server, '_PEEK_TIMEOUT', 0.5), \
+                mock.patch.object(http2server, '_wait_for_data',
+                                  wait_for_data):
+            stream = IOStream(socket.socket())
+            yield stream.connect(('127.0.0.1', self.port))
+            # As ambiguous as the start of the preface or a POST
+            yield stream.write(b'P')
+            yield gen.sleep(0.7)
+        # Backing off rather than polling every 10ms
+        self.assertLess(wait_for_data.call_count, 10)
+        self.assertEqual(self.server._negotiating, 0)
+
+        yield stream.write(
+            b'OST /hello HTTP/1.1\r\nHost: localhost\r\n'
+            b'Content-Length: 0\r\n\r\n')
+        status_line = yield stream.read_until(b'\r\n')
+        # HelloHandler only answers GET
+        self.assertEqual(status_line, b'HTTP/1.1 405 Method Not Allowed\r\n')
+        stream.close()
+
+
+class ServerTestCase(AsyncTestCase):
+    """Serves `handlers` through an HTTP2Server started by `start_server`.
+
+    """
+
+    handlers = [
+        (r'/hello', HelloHandler),
+        (r'/slow', SlowHandler),
+    ]
+
+    def setUp(self):
+        super(ServerTestCase, self).setUp()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        super(ServerTestCase, self).tearDown()
+
+    def start_server(self, **kwargs):
+        self.server = HTTP2Server(web.Application(self.handlers), **kwargs)
+        sock, self.port = bind_unused_port()
+        self.server.add_socket(sock)
+
+
+class AdmissionTest(ServerTestCase):
+
+    @gen_test
+    def test_streams_over_max_concurrent_streams_refused(self):
+        self.start_server(max_concurrent_streams=1)
+        client = yield H2Client.connect(self.port)
+        # Sent before the client got the server's SETTINGS
+        slow_id = client.send_headers('GET', '/slow')
+        refused_id = client.send_headers('GET', '/hello')
+        yield client.flush()
+        yield client.read_until(lambda: all(
+            client.responses[stream_id].ended
+            for stream_id in (slow_id, refused_id)))
+        self.assertEqual(client.responses[slow_id].status, 200)
+        # REFUSED_STREAM
+        self.assertEqual(client.responses[refused_id].reset, 7)
+        self.assertEqual(self.server.stats()['streams_refused'], 1)
+        client.close()
+
+    @gen_test
+    def test_exhausted_budget_sheds_load(self):
+        self.start_server(max_inflight_requests=1)
+        client = yield H2Client.connect(self.port)
+        slow_id = client.send_headers('GET', '/slow')
+        refused_id = client.send_headers('GET', '/hello')
+        yield client.flush()
+        refused = client.responses[refused_id]
+        yield client.read_until(lambda: refused.ended)
+        self.assertEqual(refused.reset, 7)
+        # Only the stream already open is allowed
+        self.assertEqual(client.conn.remote_settings.max_concurrent_streams, 1)
+
+        slow = client.responses[slow_id]
+        yield client.read_until(lambda: slow.ended)
+        self.assertEqual(slow.status, 200)
+        response = yield client.fetch('GET', '/hello')
+        self.assertEqual(response.status, 200)
+        stats = self.server.stats()
+        self.assertEqual(stats['requests_refused'], 1)
+        self.assertEqual(stats['requests_in_flight'], 0)
+        client.close()
+
+    @gen_test
+    def test_connections_over_max_connections_refused(self):
+        self.start_server(max_connections=1)
+        client = yield H2Client.connect(self.port)
+        response = yield client.fetch('GET', '/hello')
+        self.assertEqual(response.status, 200)
+
+        stream = IOStream(socket.socket())
+        yield stream.connect(('127.0.0.1', self.port))
+        data = yield stream.read_until_close()
+        self.assertEqual(data, b'')
+        self.assertEqual(self.server.stats()['connections_refused'], 1)
+        client.close()
+
+
+class FlowControlSchedulerTest(AsyncTestCase):
+
+    def setUp(self):
+        super(FlowControlSchedulerTest, self).setUp()
+        self.client = H2Connection(H2Configuration(
+            client_side=True, header_encoding='utf-8'))
+        self.server = H2Connection(H2Configuration(
+            client_side=False, header_encoding='utf-8'))
+        self.client.initiate_connection()
+        self.server.initiate_connection()
+        self.exchange()
+        self.scheduler = FlowControlScheduler(
+            self.server, self.write_to_stream, self.io_loop)
+        # (stream_id, size, end_stream) of the DATA frames received
+        self.frames = []
+
+    def exchange(self):
+        self.server.receive_data(self.client.data_to_send())
+        self.client.receive_data(self.server.data_to_send())
+
+    def open_stream(self, stream_id):
+        self.client.send_headers(stream_id, [
+            (':method', 'GET'), (':path', '/'), (':scheme', 'http'),
+            (':authority', 'localhost')], end_stream=True)
+        self.exchange()
+        self.server.send_headers(stream_id, [(':status', '200')])
+
+    def write_to_stream(self, size_hint=0):
+        for event in self.client.receive_data(self.server.data_to_send()):
+            if isinstance(event, h2.events.DataReceived):
+                self.frames.append((
+                    event.stream_id, len(event.data),
+                    event.stream_ended is not None))
+        future = gen.Future()
+        future.set_result(None)
+        return future
+
+    @gen_test
+    def test_data_split_in_frames_within_window(self):
+        self.open_stream(1)
+        future = self.scheduler.send_data(1, b'x' * 70000, end_stream=True)
+        yield gen.sleep(0.05)
+        # The client's default frame size and windows
+        self.assertEqual(self.frames, [
+            (1, 16384, False), (1, 16384, False), (1, 16384, False),
+            (1, 16383, False)])
+        self.assertFalse(future.done())
+        self.assertTrue(self.scheduler.stalled)
+
+        self.client.increment_flow_control_window(10000)
+        self.client.increment_flow_control_window(10000, 1)
+        self.exchange()
+        self.scheduler.window_updated(0)
+        yield future
+        self.assertEqual(self.frames[-1], (1, 4465, True))
+        self.assertFalse(self.scheduler.stalled)
+
+    @gen_test
+    def test_dependent_stream_sent_after_its_parent(self):
+        for stream_id in (1, 3):
+            self.open_stream(stream_id)
+        self.scheduler.prioritize(3)
+        self.scheduler.prioritize(1, depends_on=3)
+        futures = [
+            self.scheduler.send_data(stream_id, b'x' * 20000, end_stream=True)
+            for stream_id in (1, 3)]
+        yield futures
+        self.assertEqual([stream_id for stream_id, _, _ in self.frames],
+                         [3, 3, 1, 1])
+
+    @gen_test
+    def test_bandwidth_shared_by_weight(self):
+        for stream_id in (1, 3):
+            self.open_stream(stream_id)
+        self.scheduler.prioritize(1, weight=64)
+        self.scheduler.prioritize(3, weight=16)
+        # A frame at a time
+        self.scheduler.round_size = 1
+        futures = [
+            self.scheduler.send_data(stream_id, b'x' * 8000, end_stream=True)
+            for stream_id in (1, 3)]
+        self.server.max_outbound_frame_size = 1000
+        yield futures
+        first_ten = [stream_id for stream_id, _, _ in self.frames[:10]]
+        self.assertEqual(first_ten.count(1), 8)
+        self.assertEqual(first_ten.count(3), 2)
+
+
+class DrainTest(ServerTestCase):
+
+    @gen_test
+    def test_drain_lets_streams_in_progress_finish(self):
+        self.start_server()
+        client = yield H2Client.connect(self.port)
+        slow_id = client.send_headers('GET', '/slow')
+        yield client.flush()
+        yield gen.sleep(0.05)
+        drained = self.server.drain()
+        yield client.read_until(lambda: client.goaways)
+        # NO_ERROR, with the last stream accepted
+        self.assertEqual(client.goaways, [(slow_id, 0)])
+
+        # Opened after the GOAWAY, safe to retry elsewhere
+        late_id = client.send_headers('GET', '/hello')
+        yield client.flush()
+        slow = client.responses[slow_id]
+        late = client.responses[late_id]
+        yield client.read_until(lambda: slow.ended and late.ended)
+        self.assertEqual(slow.status, 200)
+        self.assertEqual(slow.data, b'Slow')
+        self.assertEqual(late.reset, 7)
+
+        result = yield drained
+        self.assertEqual(
+            result, {'streams_drained': 1, 'streams_aborted': 0})
+        self.assertEqual(self.server.stats()['streams_refused'], 1)
+        client.close()
+
+    @gen_test
+    def test_drain_aborts_streams_past_timeout(self):
+        self.start_server()
+        client = yield H2Client.connect(self.port)
+        slow_id = client.send_headers('GET', '/slow')
+        yield client.flush()
+        yield gen.sleep(0.05)
+        drained = self.server.drain(timeout=0.05)
+        slow = client.responses[slow_id]
+        yield client.read_until(lambda: slow.ended)
+        # CANCEL
+        self.assertEqual(slow.reset, 8)
+
+        result = yield drained
+        self.assertEqual(
+            result, {'streams_drained': 0, 'streams_aborted': 1})
+        client.close()
+
+
+class TimeoutTest(ServerTestCase):
+
+    @gen_test
+    def test_idle_connection_closed_gracefully(self):
+        self.start_server(idle_connection_timeout=0.1)
+        client = yield H2Client.connect(self.port)
+        response = yield client.fetch('GET', '/hello')
+        self.assertEqual(response.status, 200)
+        server_conn, = self.server._connections
+        yield client.read_until(lambda: client.goaways)
+        self.assertEqual(client.goaways[0], (1, 0))
+        yield client.stream.read_until_close()
+        # Waits for the serving loop to exit
+        yield server_conn.close()
+        self.assertEqual(self.server.stats()['connections'], 0)
+
+    @gen_test
+    def test_ping_measures_rtt(self):
+        self.start_server(ping_interval=0.05, ping_timeout=1)
+        client = yield H2Client.connect(self.port)
+        response = yield client.fetch('GET', '/hello')
+        self.assertEqual(response.status, 200)
+        server_conn, = self.server._connections
+        yield client.read_until(
+            lambda: server_conn.h2_connection.rtt is not None)
+        self.assertLess(server_conn.h2_connection.rtt, 1)
+        client.close()
+
+    @gen_test
+    def test_unanswered_ping_closes_connection(self):
+        self.start_server(ping_interval=0.05, ping_timeout=0.1)
+        client = yield H2Client.connect(self.port)
+        yield client.read_until(lambda: self.server._connections)
+        server_conn, = self.server._connections
+        with self.assertLogs('tornado.general', 'INFO'):
+            # Never acknowledging the PINGs
+            yield client.stream.read_until_close()
+        yield server_conn.close()
+        self.assertEqual(self.server.stats()['connections'], 0)
+
+
+class StaticFileTest(ServerTestCase):
+
+    def setUp(self):
+        super(StaticFileTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.css = b'body { margin: 0; }\n' * 100
+        self.write_file('style.css', self.css)
+        self.write_file('app.js', b'var app = {};\n' * 100)
+        self.js_gz = gzip.compress(b'var app = {};\n' * 100)
+        self.write_file('app.js.gz', self.js_gz)
+        self.cache = StaticContentCache(gzip=True)
+        self.handlers = [
+            (r'/cached/(.*)', HTTP2StaticFileHandler,
+             {'path': self.path, 'cache': self.cache}),
+            (r'/precompressed/(.*)', HTTP2StaticFileHandler,
+             {'path': self.path, 'precompressed': True}),
+        ]
+        self.start_server()
+
+    def write_file(self, name, content):
+        with open(os.path.join(self.path, name), 'wb') as f:
+            f.write(content)
+
+    @gen_test
+    def test_cached_file_compressed_for_clients_accepting_gzip(self):
+        client = yield H2Client.connect(self.port)
+        response = yield client.fetch(
+            'GET', '/cached/style.css', [('accept-encoding', 'gzip')])
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['content-encoding'], 'gzip')
+        self.assertEqual(response.headers['vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.data), self.css)
+        self.assertEqual(len(self.cache), 1)
+
+        etag = response.headers['etag']
+        response = yield client.fetch(
+            'GET', '/cached/style.css',
+            [('accept-encoding', 'gzip'), ('if-none-match', etag)])
+        self.assertEqual(response.status, 304)
+
+        response = yield client.fetch('GET', '/cached/style.css')
+        self.assertEqual(response.status, 200)
+        self.assertNotIn('content-encoding', response.headers)
+        self.assertNotEqual(response.headers['etag'], etag)
+        self.assertEqual(response.data, self.css)
+        client.close()
+
+    @gen_test
+    def test_cached_file_replaced_once_modified(self):
+        client = yield H2Client.connect(self.port)
+        response = yield client.fetch('GET', '/cached/style.css')
+        self.assertEqual(response.data, self.css)
+        self.write_file('style.css', b'p { color: red; }\n')
+        response = yield client.fetch('GET', '/cached/style.css')
+        self.assertEqual(response.data, b'p { color: red; }\n')
+        client.close()
+
+    @gen_test
+    def test_precompressed_file_served_to_clients_accepting_it(self):
+        client = yield H2Client.connect(self.port)
+        response = yield client.fetch(
+            'GET', '/precompressed/app.js', [('accept-encoding', 'br, gzip')])
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['content-encoding'], 'gzip')
+        # Rather than the type of a .gz file
+        self.assertEqual(response.headers['content-type'],
+                         mimetypes.guess_type('app.js')[0])
+        self.assertEqual(response.data, self.js_gz)
+
+        response = yield client.fetch('GET', '/precompressed/app.js')
+        self.assertNotIn('content-encoding', response.headers)
+        self.assertEqual(response.data, b'var app = {};\n' * 100)
+        client.close()
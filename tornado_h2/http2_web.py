@@ -2,26 +2,465 @@
 Extensions to the web.py module for use in HTTP2
 
 """
+import collections
+import gzip
+import hashlib
 import logging
+import mimetypes
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+from tornado import gen
+from tornado import httputil
+from tornado import iostream
 from tornado.web import StaticFileHandler
 
+from tornado_h2.http2compression import (
+    EXTENSIONS, is_compressible, negotiate_encoding)
+
 log = logging.getLogger(__name__)
 
 
+class _CachedFile(object):
+    """Contents of a static file along with the values derived from them.
+
+    """
+
+    __slots__ = ('mtime', 'size', 'content', 'etag', 'variants')
+
+    def __init__(self, stat_result, content):
+        self.mtime = stat_result.st_mtime
+        self.size = stat_result.st_size
+        self.content = content
+        # Same hash as StaticFileHandler.get_content_version
+        self.etag = hashlib.md5(content).hexdigest()
+        # Pre-compressed contents keyed by content coding
+        self.variants = {}
+
+    @property
+    def cost(self):
+        return len(self.content) + sum(
+            len(variant) for variant in self.variants.values())
+
+    def is_fresh(self, stat_result):
+        return (self.mtime == stat_result.st_mtime and
+                self.size == stat_result.st_size)
+
+
+class StaticContentCache(object):
+    """In memory LRU cache of small static files for HTTP2StaticFileHandler.
+
+    Files up to `max_file_size` bytes are kept until the total exceeds
+    `max_bytes`, the least recently used being evicted first. Entries are
+    checked against the modification time and size of the file on each hit
+    and replaced if they changed.
+
+    If `gzip` is True a compressed copy of compressible files is also kept
+    and served to clients accepting it.
+
+    A single instance is meant to be shared by the handlers serving the
+    same files, passing it as the `cache` argument of their initialize.
+
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_file_size=1024 * 1024,
+                 gzip=False, compress_level=6):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.gzip = gzip
+        self.compress_level = compress_level
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, abspath, stat_result):
+        """Returns the entry for `abspath` if present and up to date.
+
+        """
+        entry = self._entries.get(abspath)
+        if entry is None:
+            return None
+        if not entry.is_fresh(stat_result):
+            self._remove(abspath)
+            return None
+        self._entries.move_to_end(abspath)
+        return entry
+
+    def put(self, abspath, stat_result, content, compressible=False):
+        """Caches `content` as read from `abspath`, returns the new entry.
+
+        """
+        entry = _CachedFile(stat_result, content)
+        if self.gzip and compressible:
+            compressed = gzip.compress(content, self.compress_level)
+            if len(compressed) < len(content):
+                entry.variants['gzip'] = compressed
+
+        self._remove(abspath)
+        if entry.cost <= self.max_bytes:
+            self._entries[abspath] = entry
+            self.size += entry.cost
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.cost
+        return entry
+
+    def _remove(self, abspath):
+        entry = self._entries.pop(abspath, None)
+        if entry is not None:
+            self.size -= entry.cost
+
+
+def _read_range(abspath, start=0, size=-1):
+    with open(abspath, 'rb') as file:
+        file.seek(start)
+        return file.read(size)
+
+
+def _map_file(abspath):
+    # The mapping keeps its own handle, the file can be closed right away
+    with open(abspath, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _fault_in(view):
+    """Touches every page of a slice of a mapped file so sending it doesn't
+    block the IOLoop on disk reads.
+
+    """
+    view[::mmap.PAGESIZE].tobytes()
+    return view
+
+
 class HTTP2StaticFileHandler(StaticFileHandler):
     """Subclass of the StaticFileHandler with flexible chunk size support.
 
     Requires specifically setting it as static file handler in the Router
     of Application object.
 
+    When served through HTTP/2 files are read in chunks of whole frames of
+    the size the client accepts, as many as fit in the stream's flow control
+    window up to `max_chunk_size`. The size is worked out before each read
+    so it follows any change in the client's settings mid-transfer.
+
+    Optionally a `StaticContentCache` can be passed as `cache` to serve
+    small files from memory, along with their ETag, Content-Length and
+    compressed versions. With `precompressed` set files compressed ahead of
+    time, as `style.css.br` or `style.css.gz` for `style.css`, are served
+    instead of the original to clients accepting their encoding.
+
+    The file system is accessed on a thread pool shared by all handlers so
+    the IOLoop is never blocked by slow disks, reading up to `read_ahead`
+    chunks ahead of the one being sent. Files of at least `mmap_threshold`
+    bytes are mapped in memory and sent as slices of the mapping, no copies
+    of them are made until the DATA frames are serialized.
+
     """
 
-    def should_return_304(self):
-        """Skip cache.
+    #: Upper bound of the chunk size, however large the window
+    max_chunk_size = 1024 * 1024
+
+    #: Chunk size used when the connection does not expose its frame size
+    default_chunk_size = 64 * 1024
+
+    #: Number of chunks read in advance of the one being sent
+    read_ahead = 2
+
+    #: Files of at least this size are mapped in memory instead of read
+    mmap_threshold = 1024 * 1024
+
+    #: Size of the thread pool reading files
+    max_read_workers = 4
+
+    _executor = None
+    _executor_pid = None
+
+    def initialize(self, path, default_filename=None, cache=None,
+                   precompressed=False):
+        super(HTTP2StaticFileHandler, self).initialize(path, default_filename)
+        self.cache = cache
+        self.precompressed = precompressed
+        self._precompressed_encoding = None
+        self._cache_entry = None
+
+    @classmethod
+    def get_executor(cls):
+        """Returns the thread pool files are read on.
+
+        The pool is created on first use, and again in child processes after
+        a fork as its threads don't survive it.
+
+        """
+        pid = os.getpid()
+        if HTTP2StaticFileHandler._executor_pid != pid:
+            HTTP2StaticFileHandler._executor = ThreadPoolExecutor(
+                cls.max_read_workers)
+            HTTP2StaticFileHandler._executor_pid = pid
+        return HTTP2StaticFileHandler._executor
+
+    @gen.coroutine
+    def get(self, path, include_body=True):
+        """Reimplementation of StaticFileHandler.get accessing the file on
+        the executor.
+
+        """
+        # Set up our path instance variables.
+        self.path = self.parse_url_path(path)
+        del path  # make sure we don't refer to path instead of self.path again
+        absolute_path = self.get_absolute_path(self.root, self.path)
+        self.absolute_path = self.validate_absolute_path(
+            self.root, absolute_path)
+        if self.absolute_path is None:
+            return
+
+        yield self.load_file_info()
+        self.modified = self.get_modified_time()
+        self.set_headers()
+
+        if self.should_return_304():
+            self.set_status(304)
+            return
+
+        request_range = None
+        range_header = self.request.headers.get("Range")
+        if range_header:
+            # As per RFC 2616 14.16, if an invalid Range header is specified,
+            # the request will be treated as if the header didn't exist.
+            request_range = httputil._parse_request_range(range_header)
+
+        size = self.get_content_size()
+        if request_range:
+            start, end = request_range
+            if (start is not None and start >= size) or end == 0:
+                # As per RFC 2616 14.35.1, a range is not satisfiable only: if
+                # the first requested byte is equal to or greater than the
+                # content, or when a suffix with length 0 is specified
+                self.set_status(416)  # Range Not Satisfiable
+                self.set_header("Content-Type", "text/plain")
+                self.set_header("Content-Range", "bytes */%s" % (size, ))
+                return
+            if start is not None and start < 0:
+                start += size
+            if end is not None and end > size:
+                # Clients sometimes blindly use a large range to limit their
+                # download size; cap the endpoint at the actual file size.
+                end = size
+            # Note: only return HTTP 206 if less than the entire range has been
+            # requested. Not only is this semantically correct, but Chrome
+            # refuses to play audio if it gets an HTTP 206 in response to
+            # ``Range: bytes=0-``.
+            if size != (end or size) - (start or 0):
+                self.set_status(206)  # Partial Content
+                self.set_header("Content-Range",
+                                httputil._get_content_range(start, end, size))
+        else:
+            start = end = None
+
+        if start is not None and end is not None:
+            content_length = end - start
+        elif end is not None:
+            content_length = end
+        elif start is not None:
+            content_length = size - start
+        else:
+            content_length = size
+        self.set_header("Content-Length", content_length)
+
+        if include_body:
+            start = start or 0
+            yield self.send_content(start, start + content_length)
+        else:
+            assert self.request.method == "HEAD"
+
+    @gen.coroutine
+    def load_file_info(self):
+        """Does the file system access required to set the headers on the
+        executor.
+
+        That is the stat of the file, and either its contents when it fits in
+        the cache or its hash for the ETag.
+
+        """
+        executor = self.get_executor()
+        if self.precompressed:
+            yield self._find_precompressed()
+        stat_result = yield executor.submit(self._stat)
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.get(self.absolute_path, stat_result)
+            if (entry is None and
+                    stat_result.st_size <= self.cache.max_file_size):
+                content = yield executor.submit(
+                    _read_range, self.absolute_path)
+                entry = self.cache.put(
+                    self.absolute_path, stat_result, content,
+                    self._is_compressible())
+            self._cache_entry = entry
+
+        if entry is None and self.absolute_path not in self._static_hashes:
+            yield executor.submit(
+                self._get_cached_version, self.absolute_path)
+
+    @gen.coroutine
+    def _find_precompressed(self):
+        """Switches to the precompressed version of the file in the encoding
+        preferred by the client, if any.
+
+        """
+        accept_encoding = self.request.headers.get('Accept-Encoding', '')
+        encodings = list(EXTENSIONS)
+        while True:
+            encoding = negotiate_encoding(accept_encoding, encodings)
+            if encoding is None:
+                return
+            path = self.absolute_path + EXTENSIONS[encoding]
+            is_file = yield self.get_executor().submit(os.path.isfile, path)
+            if is_file:
+                self._identity_path = self.absolute_path
+                self.absolute_path = path
+                self._precompressed_encoding = encoding
+                return
+            encodings.remove(encoding)
+
+    @gen.coroutine
+    def send_content(self, start, end):
+        """Writes the content of the file from `start` to `end`.
 
         """
-        return False
+        entry = self.get_cache_entry()
+        if entry is not None:
+            self.write(self._get_cached_content(entry)[start:end])
+            try:
+                yield self.flush()
+            except iostream.StreamClosedError:
+                pass
+            return
+
+        executor = self.get_executor()
+        view = None
+        # Output transforms only take bytes
+        if end - start >= self.mmap_threshold and not self._transforms:
+            mapping = yield executor.submit(_map_file, self.absolute_path)
+            if len(mapping) < end:
+                raise IOError('{} was truncated'.format(self.absolute_path))
+            # The mapping is not closed explicitly as slices of it may still
+            # be referenced, it is unmapped once they are all released
+            view = memoryview(mapping)
+
+        pending = collections.deque()
+        offset = start
+        while offset < end or pending:
+            while offset < end and len(pending) <= self.read_ahead:
+                if view is not None:
+                    # Slicing the mapping is free, hand over large chunks and
+                    # let flow control cut them into frames
+                    size = min(self.max_chunk_size, end - offset)
+                    future = executor.submit(
+                        _fault_in, view[offset:offset + size])
+                else:
+                    size = min(self.get_content_chunk_size(), end - offset)
+                    future = executor.submit(
+                        _read_range, self.absolute_path, offset, size)
+                pending.append((future, size))
+                offset += size
+
+            future, size = pending.popleft()
+            chunk = yield future
+            if len(chunk) != size:
+                raise IOError('{} was truncated'.format(self.absolute_path))
+            try:
+                if view is not None:
+                    if not self._headers_written:
+                        yield self.flush()
+                    yield self.request.connection.write(chunk)
+                else:
+                    self.write(chunk)
+                    yield self.flush()
+            except iostream.StreamClosedError:
+                return
+
+    def get_cache_entry(self):
+        """Returns the cached file for this request, looked up or cached on
+        the executor by `load_file_info`.
+
+        Returns None if there is no cache, the file is too large for it or
+        its info isn't loaded yet.
+
+        """
+        return self._cache_entry
+
+    def get_content_encoding(self):
+        """Returns the content coding of the response, None if the file is
+        served as is.
+
+        """
+        if self._precompressed_encoding is not None:
+            return self._precompressed_encoding
+        entry = self.get_cache_entry()
+        if entry is None or not entry.variants:
+            return None
+        return negotiate_encoding(
+            self.request.headers.get('Accept-Encoding', ''), entry.variants)
+
+    def get_content_type(self):
+        if self._precompressed_encoding is None:
+            return super(HTTP2StaticFileHandler, self).get_content_type()
+        mime_type, _ = mimetypes.guess_type(self._identity_path)
+        return mime_type or 'application/octet-stream'
+
+    def _get_cached_content(self, entry):
+        encoding = self.get_content_encoding()
+        if encoding in entry.variants:
+            return entry.variants[encoding]
+        return entry.content
+
+    def _is_compressible(self):
+        return (self._precompressed_encoding is None and
+                is_compressible(self.get_content_type()))
+
+    def compute_etag(self):
+        entry = self.get_cache_entry()
+        if entry is None:
+            # Skip the lock of the hashes, held while hashing other files
+            version_hash = self._static_hashes.get(self.absolute_path)
+            if version_hash:
+                return '"%s"' % (version_hash, )
+            return super(HTTP2StaticFileHandler, self).compute_etag()
+        encoding = self.get_content_encoding()
+        if encoding in entry.variants:
+            return '"%s-%s"' % (entry.etag, encoding)
+        return '"%s"' % (entry.etag, )
+
+    def get_content_size(self):
+        entry = self.get_cache_entry()
+        if entry is None:
+            return super(HTTP2StaticFileHandler, self).get_content_size()
+        return len(self._get_cached_content(entry))
+
+    def set_extra_headers(self, path):
+        super(HTTP2StaticFileHandler, self).set_extra_headers(path)
+        entry = self.get_cache_entry()
+        if self.precompressed or (entry is not None and entry.variants):
+            self.add_header('Vary', 'Accept-Encoding')
+        encoding = self.get_content_encoding()
+        if encoding:
+            self.set_header('Content-Encoding', encoding)
+
+    def get_content_chunk_size(self):
+        """Returns the size of the next chunk to read.
+
+        """
+        connection = self.request.connection
+        frame_size = getattr(connection, 'max_frame_size', None)
+        if frame_size is None:
+            return self.default_chunk_size
+
+        frames = connection.flow_control_window // frame_size
+        frames = min(frames, self.max_chunk_size // frame_size)
+        return max(frames, 1) * frame_size
 
     @classmethod
     def get_content(cls, abspath, start=None, end=None, chunk_size=16 * 1024):
@@ -44,7 +483,7 @@ class HTTP2StaticFileHandler(StaticFileHandler):
                 if chunk:
                     if remaining is not None:
                         remaining -= len(chunk)
-                    log.debug('Yielding chunk of size {}'.format(len(chunk)))
+                    log.debug('Yielding chunk of size %d', len(chunk))
                     yield chunk
                 else:
                     if remaining is not None:
@@ -0,0 +1,64 @@
+"""
+Admission control of the requests processed at once by a server.
+
+"""
+
+from tornado import locks
+
+
+class RequestBudget(object):
+    """Counts the requests in progress across all the HTTP/2 connections of
+    a server and refuses new ones past `limit`.
+
+    While the budget is exhausted connections refuse new streams with
+    REFUSED_STREAM, which clients may safely retry, advertise a lower
+    MAX_CONCURRENT_STREAMS and stop reading until requests finish, so load
+    beyond `limit` is pushed back to the clients rather than queued.
+
+    """
+
+    def __init__(self, limit=None):
+        """
+        :arg int limit: maximum number of requests in progress, None for no
+            limit.
+        """
+        self.limit = limit
+        self.in_flight = 0
+        self.refused = 0
+        self._released = locks.Condition()
+
+    @property
+    def exhausted(self):
+        return self.limit is not None and self.in_flight >= self.limit
+
+    def try_acquire(self):
+        """Counts a new request in, returns False if it must be refused.
+
+        """
+        if self.exhausted:
+            self.refused += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def acquire(self):
+        """Counts in a request which can't be refused.
+
+        """
+        self.in_flight += 1
+
+    def release(self):
+        """Counts out a finished request.
+
+        """
+        self.in_flight -= 1
+        if not self.exhausted:
+            self._released.notify_all()
+
+    def wait(self, timeout=None):
+        """Returns a Future resolved once a request finishes with the
+        budget no longer exhausted, or at `timeout` as an `IOLoop.time`
+        deadline.
+
+        """
+        return self._released.wait(timeout)
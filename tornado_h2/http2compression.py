@@ -0,0 +1,107 @@
+"""
+Streaming compression of HTTP/2 responses.
+
+"""
+
+import collections
+import zlib
+
+from tornado.web import GZipContentEncoding
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class GzipCompressor(object):
+    """Incremental gzip compressor.
+
+    The output of every `compress` call is flushed so the client can decode
+    each chunk as soon as it's received, as needed by streamed responses.
+
+    """
+
+    encoding = 'gzip'
+
+    def __init__(self, level=6):
+        self._compressobj = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return (self._compressobj.compress(data) +
+                self._compressobj.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self._compressobj.flush()
+
+
+class BrotliCompressor(object):
+    """Incremental brotli compressor, only available if brotli is installed.
+
+    """
+
+    encoding = 'br'
+
+    def __init__(self, level=6):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+#: Compressors by content coding, in order of preference
+COMPRESSORS = collections.OrderedDict()
+if brotli is not None:
+    COMPRESSORS[BrotliCompressor.encoding] = BrotliCompressor
+COMPRESSORS[GzipCompressor.encoding] = GzipCompressor
+
+#: Responses shorter than this are not worth compressing
+MIN_LENGTH = GZipContentEncoding.MIN_LENGTH
+
+#: Extensions of precompressed files by content coding, in order of
+#: preference
+EXTENSIONS = collections.OrderedDict([('br', '.br'), ('gzip', '.gz')])
+
+
+def is_compressible(content_type):
+    """Whether a response of `content_type` is worth compressing.
+
+    """
+    content_type = content_type.split(';')[0].strip()
+    return (content_type.startswith('text/') or
+            content_type in GZipContentEncoding.CONTENT_TYPES)
+
+
+def negotiate_encoding(accept_encoding, encodings):
+    """Returns the content coding in `encodings` preferred by the client
+    according to its Accept-Encoding header, or None for no encoding.
+
+    Ties are settled by the order of `encodings`.
+
+    """
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding] = qvalue
+
+    best_encoding, best_qvalue = None, 0
+    for encoding in encodings:
+        qvalue = qvalues.get(encoding, qvalues.get('*', 0))
+        if qvalue > best_qvalue:
+            best_encoding, best_qvalue = encoding, qvalue
+    return best_encoding
@@ -0,0 +1,289 @@
+"""
+Flow control and priority aware scheduling of outgoing DATA frames.
+
+"""
+
+import collections
+import logging
+
+from tornado import gen
+from tornado import iostream
+from tornado.concurrent import chain_future
+
+from tornado_h2.http2priority import PriorityTree
+
+log = logging.getLogger('tornado.application')
+
+
+class _PendingData(object):
+    """A chunk of data queued for a stream and how much of it has been sent.
+
+    Chunks spanning several frames are cut from a `memoryview` using
+    `offset` as cursor, so no intermediate copies are made however large the
+    chunk, chunks fitting in a single frame are handed over untouched.
+
+    """
+
+    __slots__ = ('data', 'view', 'offset', 'end_stream', 'future')
+
+    def __init__(self, data, end_stream, future):
+        if isinstance(data, bytearray):
+            # Don't lock the caller's buffer by exporting a view of it
+            data = bytes(data)
+        self.data = data
+        self.view = None
+        self.offset = 0
+        self.end_stream = end_stream
+        self.future = future
+
+    @property
+    def remaining(self):
+        return len(self.data) - self.offset
+
+    def next_frame(self, size):
+        """Returns the next `size` bytes of data and advances the cursor.
+
+        """
+        if not self.offset and size == len(self.data):
+            self.offset = size
+            return self.data
+
+        if self.view is None:
+            self.view = memoryview(self.data)
+        frame = self.view[self.offset:self.offset + size]
+        self.offset += size
+        return frame
+
+
+class FlowControlScheduler(object):
+    """Sends the DATA frames of every stream in a connection within the
+    limits of the flow control windows and the peer's maximum frame size.
+
+    Data written by the streams is queued and sent in rounds of at most
+    `round_size` bytes, one frame at a time, to the stream chosen by the
+    connection's `PriorityTree` among those with an open window, that is the
+    minimum of the stream and connection windows as tracked by H2Connection.
+    The next round starts once the previous one has been written to the TCP
+    stream, so higher priority streams are not stuck behind data already
+    buffered for others.
+
+    Streams whose window is exhausted are parked until a WindowUpdated
+    opens it again. The time they spend parked is added up in
+    `stream_stall_time`, and the time during which no stream at all could
+    send in `connection_stall_time`.
+
+    """
+
+    def __init__(self, conn, write_to_stream, io_loop, round_size=65536,
+                 max_idle_priority_nodes=None):
+        """
+        :arg conn: the `H2Connection` the data is sent through.
+        :arg write_to_stream: callable writing the data pending in `conn` to
+            the TCP stream, called with the number of bytes sent since the
+            last call it must return a Future resolved once written.
+        :arg io_loop: the `IOLoop` of the connection.
+        :arg round_size: maximum number of bytes sent between writes to the
+            TCP stream.
+        :arg max_idle_priority_nodes: most streams not open kept in the
+            priority tree, see `PriorityTree`.
+        """
+        self.conn = conn
+        self.write_to_stream = write_to_stream
+        self.io_loop = io_loop
+        self.round_size = round_size
+        self.priority = PriorityTree(max_idle_priority_nodes)
+        self._queues = collections.OrderedDict()
+        self._round_scheduled = False
+        self._writing = False
+        self.stream_stall_time = 0.0
+        self.connection_stall_time = 0.0
+        self._stalled_since = {}
+        self._stream_stalls = collections.defaultdict(float)
+        self._blocked_since = None
+
+    def send_data(self, stream_id, data, end_stream=False):
+        """Queues `data` to be sent on `stream_id`.
+
+        Returns a Future resolved once all of `data` has been written to the
+        TCP stream, which may require waiting for higher priority streams or
+        for the peer to open the flow control window.
+
+        """
+        future = gen.Future()
+        queue = self._queues.get(stream_id)
+        if not data and not end_stream:
+            # Nothing to send, resolve along with the data queued before it
+            if queue:
+                chain_future(queue[-1].future, future)
+            else:
+                future.set_result(None)
+            return future
+
+        if not data and queue:
+            # Ending the stream, do it on the last frame of the queued data
+            # rather than on an extra empty one
+            queue[-1].end_stream = True
+            chain_future(queue[-1].future, future)
+            return future
+
+        if queue is None:
+            queue = self._queues[stream_id] = collections.deque()
+        queue.append(_PendingData(data, end_stream, future))
+        self._schedule_round()
+        return future
+
+    def discard(self, stream_id):
+        """Drops the data queued for a stream which has been closed.
+
+        The Futures of the discarded writes fail with StreamClosedError.
+
+        """
+        for pending in self._queues.pop(stream_id, ()):
+            pending.future.set_exception(iostream.StreamClosedError())
+            pending.future.add_done_callback(lambda f: f.exception())
+        self.priority.remove(stream_id)
+        if stream_id in self._stalled_since:
+            self._end_stall(stream_id)
+        if not self._queues:
+            self._end_block()
+
+    def pop_stall_time(self, stream_id):
+        """Returns the seconds `stream_id` was parked, and forgets it.
+
+        """
+        if stream_id in self._stalled_since:
+            self._end_stall(stream_id)
+        return self._stream_stalls.pop(stream_id, 0.0)
+
+    def _end_stall(self, stream_id):
+        stalled = self.io_loop.time() - self._stalled_since.pop(stream_id)
+        self.stream_stall_time += stalled
+        self._stream_stalls[stream_id] += stalled
+
+    @property
+    def stalled(self):
+        """Whether any stream is parked until the peer opens its window.
+
+        """
+        return bool(self._stalled_since)
+
+    def is_parked(self, stream_id):
+        """Whether `stream_id` has data waiting to be sent.
+
+        """
+        return stream_id in self._queues
+
+    def prioritize(self, stream_id, depends_on=None, weight=None,
+                   exclusive=False, idle=False):
+        """Handles priority information for `stream_id`, from either its
+        request's HEADERS or a PRIORITY frame, `idle` if it isn't open.
+
+        """
+        self.priority.insert(stream_id, depends_on, weight, exclusive, idle)
+
+    def window_updated(self, stream_id):
+        """Resume the streams whose window was opened by a WindowUpdated.
+
+        A `stream_id` of 0 refers to the connection window, which resumes
+        every parked stream.
+
+        """
+        if stream_id == 0 or stream_id in self._queues:
+            log.debug('Resuming after window update for stream %d', stream_id)
+            self._schedule_round()
+
+    def settings_changed(self):
+        """Resume every parked stream after the peer changed its settings.
+
+        A new INITIAL_WINDOW_SIZE changes the window of all streams without
+        any WindowUpdated being received.
+
+        """
+        self._schedule_round()
+
+    def _schedule_round(self):
+        if self._queues and not (self._round_scheduled or self._writing):
+            self._round_scheduled = True
+            self.io_loop.add_callback(self._send_round)
+
+    def _ready_streams(self):
+        """Returns the streams which can send a frame right now.
+
+        """
+        ready = []
+        for stream_id, queue in self._queues.items():
+            pending = queue[0]
+            if (not pending.remaining or
+                    self.conn.local_flow_control_window(stream_id) > 0):
+                ready.append(stream_id)
+                if stream_id in self._stalled_since:
+                    self._end_stall(stream_id)
+            elif stream_id not in self._stalled_since:
+                self._stalled_since[stream_id] = self.io_loop.time()
+
+        if ready:
+            self._end_block()
+        elif self._queues and self._blocked_since is None:
+            self._blocked_since = self.io_loop.time()
+        return ready
+
+    def _end_block(self):
+        if self._blocked_since is not None:
+            self.connection_stall_time += (
+                self.io_loop.time() - self._blocked_since)
+            self._blocked_since = None
+
+    def _send_round(self):
+        self._round_scheduled = False
+        sent_futures = []
+        frames_sent = False
+        budget = self.round_size
+        while budget > 0:
+            stream_id = self.priority.next_stream(self._ready_streams())
+            if stream_id is None:
+                break
+            size = self._send_frame(stream_id, sent_futures)
+            self.priority.account(stream_id, size)
+            frames_sent = True
+            budget -= max(size, 1)
+
+        if not frames_sent:
+            return
+
+        write_future = self.write_to_stream(self.round_size - budget)
+        for future in sent_futures:
+            chain_future(write_future, future)
+        self._writing = True
+        self.io_loop.add_future(write_future, self._on_round_written)
+
+    def _on_round_written(self, future):
+        self._writing = False
+        if future.exception() is None:
+            self._schedule_round()
+
+    def _send_frame(self, stream_id, sent_futures):
+        """Sends a single frame of queued data for `stream_id`.
+
+        Futures of fully sent chunks are appended to `sent_futures`, returns
+        the size of the data sent.
+
+        """
+        queue = self._queues[stream_id]
+        pending = queue[0]
+        size = min(
+            pending.remaining,
+            self.conn.local_flow_control_window(stream_id),
+            self.conn.max_outbound_frame_size)
+        chunk = pending.next_frame(size)
+        end_stream = pending.end_stream and not pending.remaining
+        self.conn.send_data(
+            stream_id=stream_id, data=chunk, end_stream=end_stream)
+
+        if not pending.remaining:
+            queue.popleft()
+            sent_futures.append(pending.future)
+            if not queue:
+                del self._queues[stream_id]
+            if end_stream:
+                self.priority.remove(stream_id)
+        return size
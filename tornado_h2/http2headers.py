@@ -0,0 +1,89 @@
+"""
+Conversion of headers to the form sent to H2 and their HPACK encoding.
+
+"""
+
+from hpack import NeverIndexedHeaderTuple
+from hpack.table import HeaderTable
+
+
+#: HTTP/1.1 headers specific to a connection, not allowed in HTTP/2
+CONNECTION_HEADERS = frozenset((
+    'connection', 'host', 'http2-settings', 'keep-alive', 'proxy-connection',
+    'transfer-encoding', 'upgrade'))
+
+#: Headers kept out of the HPACK dynamic table by default, RFC 7541 7.1.3
+SENSITIVE_HEADERS = frozenset((
+    'authorization', 'cookie', 'proxy-authorization', 'set-cookie'))
+
+# HTTP/2 names by name in HTTPHeaders, empty for the dropped ones. Bounded
+# as applications may make up names, those past the bound are converted
+# every time.
+_h2_names = {}
+_MAX_H2_NAMES = 1000
+
+
+def _h2_name(name):
+    lower_name = name.lower()
+    h2_name = b'' if lower_name in CONNECTION_HEADERS else lower_name.encode()
+    if len(_h2_names) < _MAX_H2_NAMES:
+        _h2_names[name] = h2_name
+    return h2_name
+
+
+def h2_headers(pseudo_headers, headers, never_indexed=()):
+    """Returns `pseudo_headers` followed by the `HTTPHeaders` `headers` as
+    sent to H2, normalized so H2 needn't do it again.
+
+    Names are lowercased and encoded once and for all, connection specific
+    headers are dropped, RFC 7540 8.1.2.2, and the headers whose encoded
+    names are in `never_indexed` are sent as never indexed literals.
+
+    """
+    result = list(pseudo_headers)
+    append = result.append
+    for name, value in headers.get_all():
+        h2_name = _h2_names.get(name)
+        if h2_name is None:
+            h2_name = _h2_name(name)
+        if not h2_name:
+            continue
+        if h2_name in never_indexed:
+            append(NeverIndexedHeaderTuple(h2_name, value.strip()))
+        else:
+            append((h2_name, value.strip()))
+    return result
+
+
+class IndexedHeaderTable(HeaderTable):
+    """HPACK header table looking headers up in the static table through a
+    dict rather than a scan of its 61 entries, the bulk of the time spent
+    encoding headers.
+
+    Finds the same entries as `HeaderTable.search`.
+
+    """
+
+    # Index of the first entry matching each header and each name
+    _static_headers = {}
+    _static_names = {}
+    for index, header in enumerate(HeaderTable.STATIC_TABLE, 1):
+        _static_headers.setdefault(header, index)
+        _static_names.setdefault(header[0], index)
+    del index, header
+
+    def search(self, name, value):
+        index = self._static_headers.get((name, value))
+        if index is not None:
+            return index, name, value
+
+        index = self._static_names.get(name)
+        partial = None if index is None else (index, name, None)
+        offset = HeaderTable.STATIC_TABLE_LENGTH + 1
+        for i, (n, v) in enumerate(self.dynamic_entries):
+            if n == name:
+                if v == value:
+                    return i + offset, n, v
+                elif partial is None:
+                    partial = (i + offset, n, None)
+        return partial
@@ -0,0 +1,159 @@
+"""
+Offloading of CPU bound request handler work to executor pools.
+
+"""
+
+import functools
+import os
+import threading
+import time
+from concurrent.futures import (
+    CancelledError, ProcessPoolExecutor, ThreadPoolExecutor)
+
+
+class OffloadPool(object):
+    """Executor running work off the IOLoop, measuring the depth of its
+    queue.
+
+    A thread pool suits work releasing the GIL, such as image codecs or
+    compression in C, and can run methods of a handler. A process pool runs
+    pure Python work in parallel, but only module level functions taking and
+    returning picklable values.
+
+    The executor is created on first use, and again in child processes
+    after a fork as its workers don't survive it.
+
+    """
+
+    def __init__(self, max_workers=None, processes=False):
+        """
+        :arg int max_workers: number of workers, one per CPU by default.
+        :arg bool processes: run the work in processes rather than threads.
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.processes = processes
+        self._executor = None
+        self._executor_pid = None
+        # Updated from the workers' done callbacks
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.max_queued = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.latency = 0.0
+
+    @property
+    def executor(self):
+        pid = os.getpid()
+        if self._executor_pid != pid:
+            executor_class = (
+                ProcessPoolExecutor if self.processes else ThreadPoolExecutor)
+            self._executor = executor_class(self.max_workers)
+            self._executor_pid = pid
+        return self._executor
+
+    @property
+    def queued(self):
+        """Work submitted waiting for a worker.
+
+        """
+        return max(0, self.pending - self.max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` on the pool, returns a
+        `concurrent.futures.Future` of its result that coroutines can yield.
+
+        """
+        future = self.executor.submit(fn, *args, **kwargs)
+        submitted = time.time()
+        with self._lock:
+            self.submitted += 1
+            self.pending += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        future.add_done_callback(
+            functools.partial(self._work_done, submitted))
+        return future
+
+    def _work_done(self, submitted, future):
+        with self._lock:
+            self.pending -= 1
+            if future.cancelled():
+                self.cancelled += 1
+                return
+            self.latency += time.time() - submitted
+            if future.exception() is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def stats(self):
+        """Returns a dict with the work queued and running now, the most
+        queued at once, the work finished and its mean latency from
+        submission.
+
+        """
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                'workers': self.max_workers,
+                'pending': self.pending,
+                'queued': self.queued,
+                'max_queued': self.max_queued,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'latency_mean': self.latency / finished if finished else 0.0,
+            }
+
+
+class OffloadMixin(object):
+    """`RequestHandler` mixin running work on `offload_pool`.
+
+    Work still queued when the client resets the stream or closes the
+    connection is cancelled, its Future raising `CancelledError` which is
+    not logged as an error.
+
+    """
+
+    #: The `OffloadPool` of the handler class, shared by its requests
+    offload_pool = OffloadPool()
+
+    def offload(self, fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` on `offload_pool`, returns a Future of
+        its result.
+
+        """
+        future = self.offload_pool.submit(fn, *args, **kwargs)
+        try:
+            self._offloaded.append(future)
+        except AttributeError:
+            self._offloaded = [future]
+        return future
+
+    def on_connection_close(self):
+        for future in getattr(self, '_offloaded', ()):
+            future.cancel()
+        super(OffloadMixin, self).on_connection_close()
+
+    def log_exception(self, typ, value, tb):
+        if isinstance(value, CancelledError):
+            # Nobody's left to answer
+            return
+        super(OffloadMixin, self).log_exception(typ, value, tb)
+
+
+def offloaded(method):
+    """Decorates a method of an `OffloadMixin` handler to run on its pool,
+    calling it returns a Future of its result.
+
+    The handler is shared with the worker, so the pool must be a thread
+    pool and the method mustn't write the response.
+
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.offload(method, self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,206 @@
+"""
+Stream dependency tree deciding which stream is sent next.
+
+"""
+
+import collections
+import logging
+
+log = logging.getLogger('tornado.application')
+
+
+DEFAULT_WEIGHT = 16
+
+
+class _PriorityNode(object):
+
+    __slots__ = ('stream_id', 'parent', 'children', 'weight', 'vtime',
+                 'vtime_floor')
+
+    def __init__(self, stream_id, parent=None, weight=DEFAULT_WEIGHT):
+        self.stream_id = stream_id
+        self.parent = parent
+        self.children = []
+        self.weight = weight
+        # Virtual time of the node within its siblings, it grows with the
+        # data sent by the node's subtree inversely to its weight
+        self.vtime = parent.vtime_floor if parent is not None else 0
+        # Virtual time of the last child scheduled, used as starting point
+        # for children becoming active so they don't get bursts of data
+        self.vtime_floor = 0
+
+    def add_child(self, child, exclusive=False):
+        if exclusive:
+            for grandchild in self.children:
+                grandchild.parent = child
+            child.children.extend(self.children)
+            self.children = []
+        child.parent = self
+        self.children.append(child)
+
+    def remove_child(self, child):
+        self.children.remove(child)
+        child.parent = None
+
+    def is_descendant_of(self, node):
+        parent = self.parent
+        while parent is not None:
+            if parent is node:
+                return True
+            parent = parent.parent
+        return False
+
+
+class PriorityTree(object):
+    """Weighted dependency tree of streams as described in RFC 7540 5.3.
+
+    `next_stream` returns which of the streams ready to send data should be
+    served next: streams are only served when none of their ancestors are
+    ready and siblings share the bandwidth in proportion to their weights,
+    accounted for through `account`.
+
+    Nodes are created for any stream referenced in priority information,
+    even if never opened, as some clients use idle streams as grouping
+    placeholders. As nothing closes them, at most `max_idle_nodes` of these
+    are kept, the oldest are removed first.
+
+    """
+
+    def __init__(self, max_idle_nodes=None):
+        """
+        :arg int max_idle_nodes: most nodes kept for streams which aren't
+            open, None for no limit.
+        """
+        self.max_idle_nodes = max_idle_nodes
+        self._root = _PriorityNode(0)
+        self._nodes = {0: self._root}
+        # Nodes of streams not open, least recently referenced first
+        self._idle = collections.OrderedDict()
+
+    def __contains__(self, stream_id):
+        return stream_id in self._nodes
+
+    def insert(self, stream_id, depends_on=None, weight=None,
+               exclusive=False, idle=False):
+        """Adds a stream to the tree, or reprioritizes it if present.
+
+        `idle` tells the stream isn't open, a node which isn't idle stays
+        in the tree until `remove` is called.
+
+        """
+        if stream_id in self._nodes:
+            self.reprioritize(stream_id, depends_on, weight, exclusive, idle)
+            return
+
+        parent = self._get_or_create(depends_on or 0)
+        node = _PriorityNode(
+            stream_id, parent=parent, weight=weight or DEFAULT_WEIGHT)
+        self._nodes[stream_id] = node
+        parent.add_child(node, exclusive)
+        if idle:
+            self._idle[stream_id] = None
+            self._evict_idle()
+
+    def reprioritize(self, stream_id, depends_on=None, weight=None,
+                     exclusive=False, idle=False):
+        """Handles priority information for `stream_id`.
+
+        """
+        if stream_id not in self._nodes:
+            self.insert(stream_id, depends_on, weight, exclusive, idle)
+            return
+        if stream_id in self._idle:
+            if idle:
+                self._idle.move_to_end(stream_id)
+            else:
+                del self._idle[stream_id]
+
+        node = self._nodes[stream_id]
+        parent = self._get_or_create(depends_on or 0)
+        if parent.is_descendant_of(node):
+            # The new parent is moved to depend on the stream's former parent
+            # to avoid creating a cycle, RFC 7540 5.3.3
+            former_parent = node.parent
+            parent.parent.remove_child(parent)
+            former_parent.add_child(parent)
+
+        node.parent.remove_child(node)
+        node.weight = weight or DEFAULT_WEIGHT
+        parent.add_child(node, exclusive)
+
+    def remove(self, stream_id):
+        """Removes a closed stream from the tree.
+
+        Its children depend on its parent from then on, sharing its weight in
+        proportion to their own, RFC 7540 5.3.4.
+
+        """
+        node = self._nodes.pop(stream_id, None)
+        if node is None:
+            return
+        self._idle.pop(stream_id, None)
+
+        parent = node.parent
+        parent.remove_child(node)
+        total_weight = sum(child.weight for child in node.children)
+        for child in node.children:
+            child.weight = max(1, node.weight * child.weight // total_weight)
+            parent.add_child(child)
+
+    def next_stream(self, ready):
+        """Returns the stream in `ready` that should be sent data next.
+
+        `ready` is a collection of stream_ids with data to send and an open
+        flow control window, returns None if empty.
+
+        """
+        if not ready:
+            return None
+
+        active = set()
+        for stream_id in ready:
+            if stream_id not in self._nodes:
+                self.insert(stream_id)
+            elif self._idle and stream_id in self._idle:
+                # Opened since it was referenced
+                del self._idle[stream_id]
+            node = self._nodes[stream_id]
+            while node is not None and node.stream_id not in active:
+                active.add(node.stream_id)
+                node = node.parent
+
+        node = self._root
+        while True:
+            child = min(
+                (c for c in node.children if c.stream_id in active),
+                key=lambda c: c.vtime)
+            node.vtime_floor = child.vtime
+            if child.stream_id in ready:
+                return child.stream_id
+            node = child
+
+    def account(self, stream_id, size):
+        """Records `size` bytes being sent for `stream_id`.
+
+        """
+        node = self._nodes.get(stream_id)
+        size = max(size, 1)
+        while node is not None and node.parent is not None:
+            node.vtime = (
+                max(node.vtime, node.parent.vtime_floor) +
+                float(size) / node.weight)
+            node = node.parent
+
+    def _get_or_create(self, stream_id):
+        if stream_id not in self._nodes:
+            self.insert(stream_id, idle=True)
+        elif stream_id in self._idle:
+            self._idle.move_to_end(stream_id)
+        return self._nodes[stream_id]
+
+    def _evict_idle(self):
+        if self.max_idle_nodes is None:
+            return
+        while len(self._idle) > self.max_idle_nodes:
+            stream_id, _ = self._idle.popitem(last=False)
+            self.remove(stream_id)
@@ -0,0 +1,282 @@
+"""
+Pre-forked worker processes running HTTP2Servers.
+
+"""
+
+import logging
+import mmap
+import os
+import random
+import signal
+import struct
+
+from tornado import gen
+from tornado import ioloop
+from tornado import netutil
+from tornado import process
+
+log = logging.getLogger('tornado.application')
+
+
+_SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+
+
+def _ignore_signal(signum, frame):
+    pass
+
+
+class WorkerStats(object):
+    """Table of the `HTTP2Server.stats` of each worker in memory shared by
+    all the processes.
+
+    Workers write their stats to their own slot of the table, any process
+    can read the stats of all of them.
+
+    """
+
+    fields = (
+        'pid', 'connections', 'connections_accepted', 'streams_opened',
+        'streams_drained', 'streams_aborted', 'flushes', 'bytes_written',
+        'frames_written')
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._record = struct.Struct('{}q'.format(len(self.fields)))
+        # Anonymous mappings are shared with the processes forked later
+        self._memory = mmap.mmap(-1, slots * self._record.size)
+
+    def write(self, slot, stats):
+        self._record.pack_into(
+            self._memory, slot * self._record.size,
+            *(stats.get(name, 0) for name in self.fields))
+
+    def clear(self, slot):
+        self.write(slot, {})
+
+    def workers(self):
+        """Returns the stats of each running worker.
+
+        """
+        workers = []
+        for slot in range(self.slots):
+            values = self._record.unpack_from(
+                self._memory, slot * self._record.size)
+            if values[0]:
+                workers.append(dict(zip(self.fields, values)))
+        return workers
+
+    def aggregate(self):
+        """Returns the stats of all the workers added up.
+
+        """
+        workers = self.workers()
+        totals = dict.fromkeys(self.fields[1:], 0)
+        for stats in workers:
+            for name in totals:
+                totals[name] += stats[name]
+        totals['workers'] = len(workers)
+        return totals
+
+
+class HTTP2Workers(object):
+    """Runs an `HTTP2Server` in each of `num_processes` pre-forked workers,
+    as many as CPUs by default.
+
+    `server_factory` is called in each worker after the fork to create its
+    server, so no connection state is ever shared between processes.
+
+    The listening sockets are bound before forking and shared by all the
+    workers, or with `reuse_port` bound by each worker with SO_REUSEPORT
+    for the kernel to balance the connections between them.
+
+    The master process supervises the workers:
+
+    - Workers exiting abnormally are restarted, up to `max_restarts` times.
+    - On SIGHUP every worker is replaced by a new one, the old workers stop
+      accepting connections and drain the ones they have, giving the
+      streams in progress `drain_timeout` seconds to finish.
+      New workers are forked from the master, code imported by it is not
+      reloaded.
+    - On SIGTERM or SIGINT all the workers are stopped, draining their
+      connections likewise.
+
+    Every `stats_interval` seconds the workers publish their server's stats
+    in `stats`, a `WorkerStats` readable from any of the processes.
+
+    Only available on Unix, Linux and macOS included.
+
+    """
+
+    def __init__(self, server_factory, port, address=None, num_processes=None,
+                 reuse_port=False, backlog=128, max_restarts=100,
+                 stats_interval=1.0, drain_timeout=30):
+        self.server_factory = server_factory
+        self.port = port
+        self.address = address
+        self.num_processes = num_processes or process.cpu_count()
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.max_restarts = max_restarts
+        self.stats_interval = stats_interval
+        self.drain_timeout = drain_timeout
+        # Leave room for a new generation of workers while the old one exits
+        self.stats = WorkerStats(2 * self.num_processes)
+        self._sockets = None
+        # Slot in stats of each worker by pid
+        self._workers = {}
+        self._retiring = set()
+        self._stopping = False
+        self._restarts = 0
+
+    def start(self):
+        """Starts the workers and supervises them until they all exit.
+
+        Returns in the master process only, workers exit when their server
+        is stopped.
+
+        """
+        if ioloop.IOLoop.initialized():
+            raise RuntimeError(
+                "Cannot fork workers: IOLoop instance has already been "
+                "initialized")
+        if not self.reuse_port:
+            self._sockets = netutil.bind_sockets(
+                self.port, self.address, backlog=self.backlog)
+
+        # Signals are handled synchronously between waits for them. SIGCHLD
+        # is ignored by default, which lets some systems discard it even
+        # while blocked, a handler keeps it pending until waited for.
+        previous_handler = signal.signal(signal.SIGCHLD, _ignore_signal)
+        signal.pthread_sigmask(signal.SIG_BLOCK, _SIGNALS)
+        try:
+            log.info('Starting %d workers', self.num_processes)
+            for _ in range(self.num_processes):
+                self._spawn()
+
+            while self._workers:
+                signum = signal.sigwait(_SIGNALS)
+                if signum == signal.SIGCHLD:
+                    self._reap()
+                elif signum == signal.SIGHUP:
+                    self.replace_workers()
+                else:
+                    self.stop()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, _SIGNALS)
+            signal.signal(signal.SIGCHLD, previous_handler)
+            for sock in self._sockets or ():
+                sock.close()
+
+    def replace_workers(self):
+        """Replaces every worker with a new one.
+
+        """
+        old_workers = [
+            pid for pid in self._workers if pid not in self._retiring]
+        log.info('Replacing %d workers', len(old_workers))
+        for _ in old_workers:
+            self._spawn()
+        for pid in old_workers:
+            self._retiring.add(pid)
+            os.kill(pid, signal.SIGTERM)
+
+    def stop(self):
+        """Stops all the workers.
+
+        """
+        log.info('Stopping %d workers', len(self._workers))
+        self._stopping = True
+        for pid in self._workers:
+            os.kill(pid, signal.SIGTERM)
+
+    def _spawn(self):
+        free_slots = set(range(self.stats.slots)) - set(self._workers.values())
+        slot = min(free_slots) if free_slots else None
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, _SIGNALS)
+                random.seed()
+                self._run_worker(slot)
+            except Exception:
+                log.exception('Worker %d failed', os.getpid())
+                exit_code = 1
+            finally:
+                # Never return into the master's code
+                logging.shutdown()
+                os._exit(exit_code)
+
+        log.debug('Started worker %d', pid)
+        self._workers[pid] = slot
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid not in self._workers:
+                continue
+
+            slot = self._workers.pop(pid)
+            if slot is not None:
+                self.stats.clear(slot)
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                log.info('Worker %d replaced', pid)
+                continue
+            if os.WIFSIGNALED(status):
+                log.warning('Worker %d killed by signal %d',
+                            pid, os.WTERMSIG(status))
+            elif os.WEXITSTATUS(status) != 0:
+                log.warning('Worker %d exited with status %d',
+                            pid, os.WEXITSTATUS(status))
+            else:
+                log.info('Worker %d exited normally', pid)
+                continue
+
+            if self._stopping:
+                continue
+            self._restarts += 1
+            if self._restarts > self.max_restarts:
+                raise RuntimeError("Too many worker restarts, giving up")
+            self._spawn()
+
+    def _run_worker(self, slot):
+        # Terminal signals reach the whole process group, leave them to
+        # the master
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        io_loop = ioloop.IOLoop()
+        io_loop.make_current()
+        server = self.server_factory()
+        sockets = self._sockets
+        if sockets is None:
+            sockets = netutil.bind_sockets(
+                self.port, self.address, backlog=self.backlog,
+                reuse_port=True)
+        server.add_sockets(sockets)
+
+        if slot is not None:
+            def publish_stats():
+                self.stats.write(slot, dict(server.stats(), pid=os.getpid()))
+            publish_stats()
+            ioloop.PeriodicCallback(
+                publish_stats, self.stats_interval * 1000).start()
+
+        @gen.coroutine
+        def shutdown():
+            result = yield server.drain(self.drain_timeout)
+            log.info('Worker %d drained %d streams, aborted %d', os.getpid(),
+                     result['streams_drained'], result['streams_aborted'])
+            io_loop.stop()
+
+        signal.signal(
+            signal.SIGTERM,
+            lambda signum, frame: io_loop.add_callback_from_signal(shutdown))
+        io_loop.start()
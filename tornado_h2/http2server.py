@@ -3,20 +3,123 @@ HTTP2Server to use HTTP2ServerConnection.
 
 """
 
+import socket
+
 from tornado import gen
 from tornado import httputil
+from tornado import ioloop
+from tornado import iostream
+from tornado.http1connection import HTTP1ServerConnection
 from tornado.tcpserver import TCPServer
 from tornado.util import Configurable
-from tornado.http1connection import HTTP1ConnectionParameters
 from tornado.httpserver import (
     _HTTPRequestContext, _CallableAdapter, _ProxyAdapter)
 
-from tornado_h2.http2serverconnection import HTTP2ServerConnection
+from tornado_h2.http2admission import RequestBudget
+from tornado_h2.http2serverconnection import (
+    HTTP2ConnectionParameters, HTTP2ServerConnection, is_h2c_upgrade)
+
+
+#: Sent first by clients speaking HTTP/2, RFC 7540 3.5
+CONNECTION_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+# Polling of a socket holding too few bytes of the preface to tell it from
+# HTTP/1.1: first and longest delay between peeks, and seconds given to the
+# client to send more before its connection is handed to HTTP/1.1
+_PEEK_DELAY = 0.01
+_MAX_PEEK_DELAY = 0.5
+_PEEK_TIMEOUT = 5
+
+
+@gen.coroutine
+def negotiate_protocol(stream, deadline=None):
+    """Returns the protocol spoken on a new connection, 'h2' or 'http/1.1',
+    or None if it's closed before telling or `deadline`, in `IOLoop.time`
+    terms.
+
+    Over TLS it's the protocol selected through ALPN, HTTP/1.1 if none was
+    as required by RFC 7540 3.3. In cleartext clients with prior knowledge
+    of HTTP/2 start with the connection preface, RFC 7540 3.4, which is
+    peeked at without consuming it. Clients stalling within its first bytes
+    are served HTTP/1.1 after `_PEEK_TIMEOUT`, which waits for the rest of
+    their request without polling.
+
+    """
+    if isinstance(stream, iostream.SSLIOStream):
+        handshake = stream.wait_for_handshake()
+        try:
+            if deadline is not None:
+                handshake = gen.with_timeout(
+                    deadline, handshake,
+                    quiet_exceptions=iostream.StreamClosedError)
+            yield handshake
+        except (iostream.StreamClosedError, gen.TimeoutError):
+            raise gen.Return(None)
+        protocol = stream.socket.selected_alpn_protocol()
+        raise gen.Return('h2' if protocol == 'h2' else 'http/1.1')
+
+    io_loop = stream.io_loop
+    delay = _PEEK_DELAY
+    peek_deadline = None
+    while True:
+        readable = yield _wait_for_data(stream, deadline)
+        if not readable:
+            raise gen.Return(None)
+        try:
+            data = stream.socket.recv(
+                len(CONNECTION_PREFACE), socket.MSG_PEEK)
+        except BlockingIOError:
+            continue
+        except socket.error:
+            raise gen.Return(None)
+        if not data:
+            raise gen.Return(None)
+        if not CONNECTION_PREFACE.startswith(data):
+            raise gen.Return('http/1.1')
+        if len(data) >= 3:
+            # PRI is reserved for the preface and never an HTTP/1.1 method
+            raise gen.Return('h2')
+        # Too short to tell from a POST or a PROPFIND. The socket stays
+        # readable, so wait for more data with a backoff.
+        if peek_deadline is None:
+            peek_deadline = io_loop.time() + _PEEK_TIMEOUT
+        elif io_loop.time() >= peek_deadline:
+            raise gen.Return('http/1.1')
+        yield gen.sleep(delay)
+        delay = min(2 * delay, _MAX_PEEK_DELAY)
+
+
+def _wait_for_data(stream, deadline=None):
+    """Returns a Future resolved with True once the socket of `stream` is
+    readable, or with False at `deadline`.
+
+    """
+    io_loop = stream.io_loop
+    fd = stream.fileno()
+    future = gen.Future()
+
+    def done(readable):
+        if future.done():
+            return
+        io_loop.remove_handler(fd)
+        if timeout is not None:
+            io_loop.remove_timeout(timeout)
+        future.set_result(readable)
+    timeout = None
+    io_loop.add_handler(fd, lambda fd, events: done(True), io_loop.READ)
+    if deadline is not None:
+        timeout = io_loop.add_timeout(deadline, lambda: done(False))
+    return future
 
 
 class HTTP2Server(
         TCPServer, Configurable, httputil.HTTPServerConnectionDelegate):
 
+    #: Counters of `HTTP2Connection` added up by `stats`
+    connection_counters = (
+        'streams_opened', 'streams_refused', 'streams_drained',
+        'streams_aborted', 'flushes', 'bytes_written', 'frames_written')
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -25,22 +128,53 @@ class HTTP2Server(
                    decompress_request=False,
                    chunk_size=None, max_header_size=None,
                    idle_connection_timeout=None, body_timeout=None,
-                   max_body_size=None, max_buffer_size=None):
+                   max_body_size=None, max_buffer_size=None,
+                   max_concurrent_pushes=None, max_frame_size=None,
+                   initial_window_size=None, connection_window_size=None,
+                   max_concurrent_streams=None, header_table_size=None,
+                   max_header_list_size=None, compress_response=False,
+                   compression_level=6, stats_collector=None,
+                   never_indexed_headers=None, max_connections=None,
+                   max_inflight_requests=None, ping_interval=None,
+                   ping_timeout=None):
         self.request_callback = request_callback
         self.no_keep_alive = no_keep_alive
         self.xheaders = xheaders
         self.protocol = protocol
-        self.conn_params = HTTP1ConnectionParameters(
+        self.max_connections = max_connections
+        self.request_budget = RequestBudget(max_inflight_requests)
+        self.conn_params = HTTP2ConnectionParameters(
+            no_keep_alive=no_keep_alive,
             decompress=decompress_request,
             chunk_size=chunk_size,
             max_header_size=max_header_size,
             header_timeout=idle_connection_timeout or 3600,
             max_body_size=max_body_size,
-            body_timeout=body_timeout)
+            body_timeout=body_timeout,
+            max_concurrent_pushes=max_concurrent_pushes,
+            max_frame_size=max_frame_size,
+            initial_window_size=initial_window_size,
+            connection_window_size=connection_window_size,
+            max_concurrent_streams=max_concurrent_streams,
+            header_table_size=header_table_size,
+            max_header_list_size=max_header_list_size,
+            compress_response=compress_response,
+            compression_level=compression_level,
+            stats_collector=stats_collector,
+            never_indexed_headers=never_indexed_headers,
+            request_budget=self.request_budget,
+            ping_interval=ping_interval,
+            ping_timeout=ping_timeout)
         TCPServer.__init__(self, io_loop=io_loop, ssl_options=ssl_options,
                            max_buffer_size=max_buffer_size,
                            read_chunk_size=chunk_size)
         self._connections = set()
+        # Connections accepted whose protocol is still being negotiated
+        self._negotiating = 0
+        self.connections_accepted = 0
+        self.connections_refused = 0
+        # Counters of the connections already closed
+        self._closed_counters = dict.fromkeys(self.connection_counters, 0)
 
     @classmethod
     def configurable_base(cls):
@@ -57,9 +191,82 @@ class HTTP2Server(
             conn = next(iter(self._connections))
             yield conn.close()
 
+    @gen.coroutine
+    def drain(self, timeout=None):
+        """Stops accepting connections and closes the open ones gracefully,
+        see `HTTP2Connection.drain`.
+
+        The streams in progress are given `timeout` seconds to finish, or
+        as long as they take if None. Returns a dict with the number of
+        streams which finished and were aborted.
+
+        """
+        self.stop()
+        deadline = None
+        if timeout is not None:
+            deadline = ioloop.IOLoop.current().time() + timeout
+        connections = list(self._connections)
+        results = yield [
+            conn.drain(deadline) for conn in connections
+            if isinstance(conn, HTTP2ServerConnection)]
+        # HTTP/1.1 has no way to announce the shutdown, its connections are
+        # closed once the HTTP/2 ones are drained
+        yield [
+            conn.close() for conn in connections
+            if not isinstance(conn, HTTP2ServerConnection)]
+        raise gen.Return({
+            'streams_drained': sum(drained for drained, _ in results),
+            'streams_aborted': sum(aborted for _, aborted in results),
+        })
+
     def handle_stream(self, stream, address):
+        if (self.max_connections is not None and
+                len(self._connections) + self._negotiating >=
+                self.max_connections):
+            self.connections_refused += 1
+            stream.close()
+            return
+        future = self._start_connection(stream, address)
+        # Register the future on the IOLoop so its errors get logged.
+        stream.io_loop.add_future(future, lambda f: f.result())
+
+    @gen.coroutine
+    def _start_connection(self, stream, address):
+        """Serves a new connection over the protocol the client speaks,
+        see `negotiate_protocol`.
+
+        """
+        self._negotiating += 1
+        try:
+            # Bounded like the wait for the headers of an HTTP/1.1 request
+            deadline = stream.io_loop.time() + self.conn_params.header_timeout
+            protocol = yield negotiate_protocol(stream, deadline)
+        finally:
+            self._negotiating -= 1
+        if protocol is None:
+            stream.close()
+            return
+        context = _HTTPRequestContext(stream, address, self.protocol)
+        if protocol == 'h2':
+            conn = HTTP2ServerConnection(stream, self.conn_params, context)
+        else:
+            conn = HTTP1ServerConnection(stream, self.conn_params, context)
+        self._connections.add(conn)
+        self.connections_accepted += 1
+        conn.start_serving(self)
+
+    def upgrade(self, stream, address, start_line, headers):
+        """Switches a connection detached from HTTP/1.1 to HTTP/2, the
+        request which asked for it is answered on stream 1.
+
+        """
+        stream.write(
+            b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Connection: Upgrade\r\n'
+            b'Upgrade: h2c\r\n\r\n')
         context = _HTTPRequestContext(stream, address, self.protocol)
-        conn = HTTP2ServerConnection(stream, self.conn_params, context)
+        conn = HTTP2ServerConnection(
+            stream, self.conn_params, context, (start_line, headers))
         self._connections.add(conn)
         conn.start_serving(self)
 
@@ -74,7 +281,62 @@ class HTTP2Server(
         if self.xheaders:
             delegate = _ProxyAdapter(delegate, request_conn)
 
+        if (not isinstance(server_conn, HTTP2ServerConnection) and
+                not isinstance(request_conn.stream, iostream.SSLIOStream)):
+            delegate = _UpgradeAdapter(self, request_conn, delegate)
+
         return delegate
 
     def on_close(self, server_conn):
         self._connections.remove(server_conn)
+        if isinstance(server_conn, HTTP2ServerConnection):
+            for name in self.connection_counters:
+                self._closed_counters[name] += getattr(
+                    server_conn.h2_connection, name)
+
+    def stats(self):
+        """Returns a dict with the counters of the work done by the server
+        since it started and the number of connections open.
+
+        """
+        stats = dict(self._closed_counters)
+        for server_conn in self._connections:
+            if not isinstance(server_conn, HTTP2ServerConnection):
+                continue
+            for name in self.connection_counters:
+                stats[name] += getattr(server_conn.h2_connection, name)
+        stats['connections'] = len(self._connections)
+        stats['connections_accepted'] = self.connections_accepted
+        stats['connections_refused'] = self.connections_refused
+        stats['requests_in_flight'] = self.request_budget.in_flight
+        stats['requests_refused'] = self.request_budget.refused
+        return stats
+
+
+class _UpgradeAdapter(httputil.HTTPMessageDelegate):
+    """Switches the connection of HTTP/1.1 requests asking for it to HTTP/2
+    through `HTTP2Server.upgrade`, passes other requests to `delegate`.
+
+    """
+
+    def __init__(self, server, request_conn, delegate):
+        self.server = server
+        self.request_conn = request_conn
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        if is_h2c_upgrade(headers):
+            address = self.request_conn.context.address
+            stream = self.request_conn.detach()
+            self.server.upgrade(stream, address, start_line, headers)
+            return None
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        self.delegate.on_connection_close()
@@ -3,244 +3,1334 @@ HTTP2Connection using H2.
 
 """
 
+import base64
+import binascii
+import functools
 import logging
+import struct
 
 from tornado.http1connection import (
-    HTTP1ServerConnection, _ExceptionLoggingContext)
+    HTTP1ConnectionParameters, HTTP1ServerConnection,
+    _ExceptionLoggingContext, _GzipMessageDelegate, _QuietException)
 from tornado import gen
 from tornado import httputil
+from tornado.concurrent import chain_future
 from tornado import iostream
 from tornado import stack_context
-from tornado.log import app_log
+from tornado.log import app_log, gen_log
+from tornado.queues import Queue
 
 from h2.config import H2Configuration
-from h2.connection import H2Connection
-import h2.settings
+from h2.connection import ConnectionState, H2Connection
+from h2.errors import ErrorCodes
+from h2.exceptions import ProtocolError
+from h2.settings import SettingCodes, Settings
 import h2.events
+from hyperframe.frame import GoAwayFrame
+
+from tornado_h2.http2admission import RequestBudget
+from tornado_h2.http2compression import (
+    COMPRESSORS, MIN_LENGTH, is_compressible, negotiate_encoding)
+from tornado_h2.http2flowcontrol import FlowControlScheduler
+from tornado_h2.http2headers import (
+    CONNECTION_HEADERS, SENSITIVE_HEADERS, IndexedHeaderTable, h2_headers)
+from tornado_h2.http2stats import (
+    CLIENT_PREFACE_LENGTH, FrameCounter, StatsCollector, StreamStats)
 
 log = logging.getLogger('tornado.application')
+#: Logs every frame sent and received by the connections opened while it's
+#: enabled at DEBUG level
+frame_log = logging.getLogger('tornado_h2.frames')
+
+# Smallest read from the TCP stream, see `HTTP2Connection.read_size`
+_MIN_READ_SIZE = 65536
+# Idle streams kept in the priority tree per stream a client may open, see
+# `PriorityTree`
+_IDLE_PRIORITY_NODES_PER_STREAM = 4
+# Seconds between checks for streams stalled by flow control or receiving
+# their request body while reads are paused, see
+# `HTTP2Connection.wait_for_budget`
+_PAUSE_CHECK_INTERVAL = 0.05
+
+
+def upgrade_request_headers(start_line, headers):
+    """Returns the HTTP/2 headers of an HTTP/1.1 request upgraded to
+    HTTP/2, without the headers specific to the HTTP/1.1 connection.
+
+    """
+    request_headers = [
+        (':method', start_line.method),
+        (':path', start_line.path),
+        (':scheme', 'http'),
+        (':authority', headers.get('Host', '')),
+    ]
+    request_headers.extend(
+        (name.lower(), value) for name, value in headers.get_all()
+        if name.lower() not in CONNECTION_HEADERS)
+    return request_headers
+
+
+def is_h2c_upgrade(headers):
+    """Whether the headers of an HTTP/1.1 request ask for an upgrade to
+    cleartext HTTP/2 with valid settings, RFC 7540 3.2.
+
+    Requests with a body are left on HTTP/1.1, as it would have to be read
+    before switching protocols.
 
+    """
+    if 'h2c' not in _header_tokens(headers, 'Upgrade'):
+        return False
+    # Both are hop-by-hop, a request forwarded without them isn't asking
+    if not {'upgrade', 'http2-settings'} <= _header_tokens(
+            headers, 'Connection'):
+        return False
+    if 'Transfer-Encoding' in headers or headers.get(
+            'Content-Length', '0') != '0':
+        return False
+    settings = headers.get_list('HTTP2-Settings')
+    if len(settings) != 1:
+        return False
+    try:
+        payload = base64.urlsafe_b64decode(_pad_base64(settings[0]))
+    except (binascii.Error, ValueError):
+        return False
+    # A SETTINGS frame payload, made of 6 bytes settings
+    return len(payload) % 6 == 0
+
+
+def _header_tokens(headers, name):
+    """Returns the lowercased tokens of the comma separated lists in all
+    the `name` headers.
+
+    """
+    return {
+        token.strip().lower()
+        for value in headers.get_list(name) for token in value.split(',')}
 
-H2_PREFIXED_HEADERS = ("status", "method", "path", "scheme", "authority")
 
+def _pad_base64(value):
+    # HTTP2-Settings is sent without the trailing '=', RFC 7540 3.2.1
+    return value + '=' * (-len(value) % 4)
+
+
+def _header_table_size(table):
+    """Returns the size of the entries in an HPACK dynamic table as
+    defined in RFC 7541 4.1.
+
+    """
+    return sum(
+        32 + len(name) + len(value) for name, value in table.dynamic_entries)
 
-def prefixed_header(header):
-    lo_header = header.lower()
-    return ":" + lo_header if lo_header in H2_PREFIXED_HEADERS else lo_header
+
+def _stream_closed_future():
+    """Returns a Future failed with StreamClosedError for writes on a closed
+    stream, which the caller is free to ignore.
+
+    """
+    future = gen.Future()
+    future.set_exception(iostream.StreamClosedError())
+    future.add_done_callback(lambda f: f.exception())
+    return future
+
+
+class HTTP2ConnectionParameters(HTTP1ConnectionParameters):
+    """Parameters for `HTTP2Connection`.
+
+    Extends `HTTP1ConnectionParameters` with HTTP/2 specific options.
+
+    """
+
+    def __init__(self, max_concurrent_pushes=None, flush_threshold=None,
+                 max_frame_size=None, initial_window_size=None,
+                 connection_window_size=None, max_concurrent_streams=None,
+                 header_table_size=None, max_header_list_size=None,
+                 compress_response=False, compression_level=6,
+                 stats_collector=None, never_indexed_headers=None,
+                 request_budget=None, ping_interval=None, ping_timeout=None,
+                 **kwargs):
+        """
+        :arg int max_concurrent_pushes: maximum number of pushed streams open
+            at once in a connection, 0 disables push. Defaults to 100.
+        :arg int flush_threshold: size in bytes of the output buffered in
+            the connection past which it is written to the TCP stream right
+            away instead of at the end of the IOLoop iteration. Defaults
+            to 64KB.
+        :arg int max_frame_size: largest frame payload accepted from clients.
+        :arg int initial_window_size: inbound flow control window of each
+            stream.
+        :arg int connection_window_size: inbound flow control window of the
+            whole connection, opened with a WINDOW_UPDATE at connection start.
+        :arg int max_concurrent_streams: maximum number of streams clients
+            may open at once.
+        :arg int header_table_size: size of the HPACK table used to decode
+            request headers.
+        :arg int max_header_list_size: largest request header list accepted.
+        :arg bool compress_response: compress responses of compressible
+            types for clients accepting it.
+        :arg int compression_level: compression level of the responses.
+        :arg stats_collector: a `StatsCollector` receiving the measurements
+            of the connections and their streams.
+        :arg never_indexed_headers: names of the response headers sent as
+            HPACK never indexed literals, kept out of the compression
+            context along with their values. Defaults to
+            `SENSITIVE_HEADERS`.
+        :arg request_budget: a `RequestBudget` shared by the connections
+            of a server, bounding the requests in progress across them.
+        :arg float ping_interval: seconds between the PINGs sent to measure
+            the round trip time and check the client is still there, None
+            to send none.
+        :arg float ping_timeout: seconds to wait for a PING to be
+            acknowledged before closing the connection. Defaults to
+            `ping_interval`.
+
+        HTTP/2 settings left as None keep the H2 defaults.
+
+        The rest of the arguments are passed to `HTTP1ConnectionParameters`,
+        where ``header_timeout`` is the time connections are kept open
+        without any stream, see `HTTP2Connection.start_timers`.
+        """
+        super(HTTP2ConnectionParameters, self).__init__(**kwargs)
+        self.max_concurrent_pushes = (
+            100 if max_concurrent_pushes is None else max_concurrent_pushes)
+        self.flush_threshold = flush_threshold or 65536
+        self.connection_window_size = connection_window_size
+        self.compress_response = compress_response
+        self.compression_level = compression_level
+        self.stats_collector = stats_collector or StatsCollector()
+        self.request_budget = request_budget or RequestBudget()
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout or ping_interval
+        self.never_indexed_headers = frozenset(
+            name.lower().encode() for name in (
+                SENSITIVE_HEADERS if never_indexed_headers is None
+                else never_indexed_headers))
+        self.settings = {
+            code: value for code, value in (
+                (SettingCodes.MAX_FRAME_SIZE, max_frame_size),
+                (SettingCodes.INITIAL_WINDOW_SIZE, initial_window_size),
+                (SettingCodes.MAX_CONCURRENT_STREAMS, max_concurrent_streams),
+                (SettingCodes.HEADER_TABLE_SIZE, header_table_size),
+                (SettingCodes.MAX_HEADER_LIST_SIZE, max_header_list_size),
+            ) if value is not None
+        }
+        # Fail early on invalid values rather than on every connection
+        validator = Settings(client=False)
+        for code, value in self.settings.items():
+            validator[code] = value
 
 
 class HTTP2Connection(object):
+    """Connection level state shared by all the streams in a TCP connection.
+
+    Wraps the H2Connection state machine and keeps track of the
+    `HTTP2Stream` objects currently open, keyed by stream_id.
+
+    """
+
+    #: Name of the method handling each type of H2 event, events of other
+    #: types are ignored. Subclasses may add or replace entries, a
+    #: handler is called with the event and must not block.
+    event_handlers = {
+        h2.events.RequestReceived: 'request_received',
+        h2.events.DataReceived: 'data_received',
+        h2.events.TrailersReceived: 'trailers_received',
+        h2.events.StreamEnded: 'request_ended',
+        h2.events.StreamReset: 'stream_reset',
+        h2.events.PriorityUpdated: 'priority_updated',
+        h2.events.WindowUpdated: 'window_updated',
+        h2.events.RemoteSettingsChanged: 'remote_settings_changed',
+        h2.events.SettingsAcknowledged: 'settings_acknowledged',
+        h2.events.PingReceived: 'ping_received',
+        h2.events.PingAckReceived: 'ping_ack_received',
+        h2.events.ConnectionTerminated: 'connection_terminated',
+    }
 
-    def __init__(self, stream):
+    def __init__(self, stream, params, context, delegate_factory):
+        """
+        :arg stream: an `.IOStream`
+        :arg params: a `HTTP2ConnectionParameters`
+        :arg context: an opaque application-defined object that is accessible
+            as ``connection.context`` in each stream.
+        :arg delegate_factory: called with each new `HTTP2Stream`, it must
+            return the `HTTPMessageDelegate` handling the request.
+        """
         self.stream = stream
-        self._write_buffer = b''
-        config = H2Configuration(client_side=False, header_encoding='utf-8')
+        self.params = params
+        self.context = context
+        self.delegate_factory = delegate_factory
+        # Outbound headers are normalized beforehand by `h2_headers`
+        config = H2Configuration(
+            client_side=False, header_encoding='utf-8',
+            normalize_outbound_headers=False)
         self.conn = H2Connection(config)
-        self._flow_control_future = None
+        self.conn.encoder.header_table = IndexedHeaderTable()
+        #: Streams the client may open at once, enforced here as well since
+        #: H2 only does once the client acknowledged the setting
+        self.max_concurrent_streams = params.settings.get(
+            SettingCodes.MAX_CONCURRENT_STREAMS,
+            self.conn.local_settings.max_concurrent_streams)
+        # Whether a lower MAX_CONCURRENT_STREAMS is advertised as the
+        # server's request budget is exhausted
+        self.shedding = False
+        # Since when no stream has been open, None while some are
+        self._idle_since = stream.io_loop.time()
+        #: Round trip time measured by the last PING, in seconds
+        self.rtt = None
+        self._pings_sent = 0
+        # Payload and time of the PING awaiting its ACK
+        self._ping_in_flight = None
+        self._timeouts = {}
+        self.streams = {}
+        self._pushed_streams = set()
+        self._flush_future = None
+        self._pending_output_size = 0
+        # Frames sent behind H2Connection's back, see `drain`
+        self._extra_output = []
+        self.draining = False
+        # Highest stream id accepted for processing once draining
+        self.last_stream_id = None
+        self._drained_future = None
+        self.streams_opened = 0
+        self.streams_refused = 0
+        self.streams_drained = 0
+        self.streams_aborted = 0
+        # Most streams open at once
+        self.streams_high_water = 0
+        # Output counters, a flush is a write to the TCP stream
+        self.flushes = 0
+        self.bytes_written = 0
+        self.frames_written = 0
+        self.frames_sent = FrameCounter()
+        self.bytes_read = 0
+        self.frames_received = FrameCounter(skip=CLIENT_PREFACE_LENGTH)
+        # Whether to log the connection's events, checked once so that when
+        # disabled the hot path pays an attribute lookup instead of a call
+        self.trace = log.isEnabledFor(logging.DEBUG)
+        if frame_log.isEnabledFor(logging.DEBUG):
+            self.frames_sent.on_frame = functools.partial(
+                self._trace_frame, 'sent')
+            self.frames_received.on_frame = functools.partial(
+                self._trace_frame, 'received')
+        self.flow_control = FlowControlScheduler(
+            self.conn, self.write_to_stream, self.stream.io_loop,
+            max_idle_priority_nodes=(
+                _IDLE_PRIORITY_NODES_PER_STREAM * self.max_concurrent_streams))
+        self._handlers = {
+            event_type: getattr(self, name)
+            for event_type, name in self.event_handlers.items()}
 
     @gen.coroutine
-    def initiate_connection(self):
+    def initiate_connection(self, upgrade_request=None):
+        """Sends the connection preamble along with the configured settings.
+
+        For a connection upgraded from HTTP/1.1 `upgrade_request` is the
+        start line and headers of the request which asked for it, handled as
+        stream 1.
+
+        """
         log.debug("Initiate connection")
-        self.conn.initiate_connection()
-        yield self.stream.write(self.conn.data_to_send())
+        self.params.stats_collector.connection_opened(self)
+        if upgrade_request is None:
+            self.conn.initiate_connection()
+        else:
+            start_line, headers = upgrade_request
+            # Also opens stream 1, already half closed by the client
+            self.conn.initiate_upgrade_connection(
+                _pad_base64(headers['HTTP2-Settings']))
+        if self.params.settings:
+            self.conn.update_settings(self.params.settings)
+        window_size = self.params.connection_window_size
+        if window_size is not None:
+            increment = window_size - self.conn.inbound_flow_control_window
+            if increment > 0:
+                self.conn.increment_flow_control_window(increment)
+        if upgrade_request is not None:
+            self.flow_control.prioritize(1)
+            self.params.request_budget.acquire()
+            self._start_stream(
+                1, upgrade_request_headers(*upgrade_request), True)
+        yield self.write_to_stream()
+
+    def request_received(self, event):
+        """Handler for RequestReceived, creates a stream for the request.
+
+        The request is processed concurrently with any other stream in the
+        connection, returns the new `HTTP2Stream`.
+
+        """
+        if self.draining and event.stream_id > self.last_stream_id:
+            # Opened before the client got the GOAWAY, it is safe to retry
+            self._refuse_stream(event.stream_id)
+            return None
+        if (len(self.streams) - len(self._pushed_streams) >=
+                self.max_concurrent_streams):
+            self._refuse_stream(event.stream_id)
+            return None
+        if not self.params.request_budget.try_acquire():
+            self._refuse_stream(event.stream_id)
+            self._shed_load()
+            return None
+        if event.priority_updated is None:
+            # Otherwise H2 also emits the PriorityUpdated right after this
+            self.flow_control.prioritize(event.stream_id)
+        return self._start_stream(
+            event.stream_id, event.headers, event.stream_ended is not None)
+
+    def _refuse_stream(self, stream_id):
+        self.conn.reset_stream(stream_id, ErrorCodes.REFUSED_STREAM)
+        self.streams_refused += 1
+
+    def _shed_load(self):
+        """Advertises a MAX_CONCURRENT_STREAMS of the streams already open
+        while the server's request budget is exhausted, so the client stops
+        opening more until `wait_for_budget` restores it.
+
+        """
+        if not self.shedding and not self.closed:
+            self.shedding = True
+            self.conn.update_settings({
+                SettingCodes.MAX_CONCURRENT_STREAMS:
+                    len(self.streams) - len(self._pushed_streams)})
+
+    @property
+    def receiving_request_bodies(self):
+        """Whether any stream is still waiting for the end of its request.
+
+        """
+        return any(not stream._request_ended
+                   for stream in self.streams.values())
 
     @gen.coroutine
-    def request_received(self, event, delegate, data):
-        self.event = event
-        self.stream_id = event.stream_id
-        log.debug("_request_received: {}".format(self.stream_id))
-        if event.headers:
-            with _ExceptionLoggingContext(app_log):
-                hd = {k: v for k, v in event.headers}
-                start_line = httputil.RequestStartLine(
-                    method=hd[':method'], path=hd[':path'],
-                    version='HTTP/2.0')
-                header_future = delegate.headers_received(
-                    start_line,
-                    httputil.HTTPHeaders(hd)
-                )
-                if header_future is not None:
-                    yield header_future
-
-        delegate.data_received(data)
-        with _ExceptionLoggingContext(app_log):
-            delegate.finish()
-        raise gen.Return(True)
+    def wait_for_budget(self):
+        """Pauses reading after load was shed until the server's request
+        budget is no longer exhausted, then advertises the configured
+        MAX_CONCURRENT_STREAMS again.
 
-    def write_headers(self, start_line, headers, chunk=None, callback=None):
-        """Tornado's implementation might include a chunk of data, which may
-        be the full response if small enough.
+        Reading carries on while streams are stalled by flow control, as
+        only the client's WINDOW_UPDATEs can get them going again, or still
+        receiving their request body, as their handlers may hold the budget
+        until it's complete.
+
+        """
+        budget = self.params.request_budget
+        io_loop = self.stream.io_loop
+        while (budget.exhausted and not self.flow_control.stalled and
+               not self.receiving_request_bodies):
+            yield budget.wait(io_loop.time() + _PAUSE_CHECK_INTERVAL)
+        if not budget.exhausted and not self.closed:
+            self.shedding = False
+            self.conn.update_settings({
+                SettingCodes.MAX_CONCURRENT_STREAMS:
+                    self.max_concurrent_streams})
+
+    def push(self, stream, path, headers=None):
+        """Pushes the response for a GET on `path` associated to `stream`.
+
+        The request is built from the pseudo headers of `stream`'s request
+        along with any extra `headers` and handled through the same
+        delegates as any other request.
 
-        TODO: handle the callback.
+        Returns the promised `HTTP2Stream`, or None if the client disabled
+        push, the limit of concurrent pushes was reached or `stream` can no
+        longer be pushed on.
 
         """
-        log.debug("Write headers: {}".format(headers))
+        if not self.conn.remote_settings.enable_push:
+            log.debug('Push disabled by the client')
+            return None
+        if self.draining:
+            return None
+        if (len(self._pushed_streams) >= self.params.max_concurrent_pushes or
+                self.conn.open_outbound_streams >=
+                self.conn.remote_settings.max_concurrent_streams):
+            log.debug('Too many concurrent pushes, skipping %s', path)
+            return None
+        if not self.params.request_budget.try_acquire():
+            return None
 
-        self.start_line = start_line
+        request_headers = stream.request_headers
+        headers = httputil.HTTPHeaders(headers or {})
+        push_headers = [
+            (':method', 'GET'),
+            (':path', path),
+            (':scheme', request_headers.get(':scheme', 'https')),
+            (':authority', request_headers.get(
+                ':authority', request_headers.get('Host', ''))),
+        ]
+        promise_headers = h2_headers(
+            push_headers, headers, self.params.never_indexed_headers)
+        push_headers.extend(
+            (name.lower(), value) for name, value in headers.get_all())
 
-        self.headers = headers
-        if self.headers.get_list('Content-Length'):
-            self.bytes_to_send = int(
-                self.headers.get_list('Content-Length')[0])
-            log.debug('{}'.format(self.bytes_to_send))
+        promised_stream_id = self.conn.get_next_available_stream_id()
+        try:
+            self.conn.push_stream(
+                stream.stream_id, promised_stream_id, promise_headers)
+        except ProtocolError as e:
+            log.debug('Cannot push %s on stream %d: %s',
+                      path, stream.stream_id, e)
+            self.params.request_budget.release()
+            return None
+        if self.trace:
+            log.debug('Pushing %s on stream %d', path, promised_stream_id)
 
-        self._send_headers()
+        # The PUSH_PROMISE is buffered ahead of the data referencing the
+        # pushed resource, which is sent on a later scheduler round
+        self.write_to_stream()
+        self._pushed_streams.add(promised_stream_id)
+        self.flow_control.prioritize(
+            promised_stream_id, depends_on=stream.stream_id)
+        return self._start_stream(
+            promised_stream_id, push_headers, True, pushed=True)
 
-        if chunk:
-            if len(chunk) > self.conn.remote_settings.max_frame_size:
-                # TODO: the chunk size is derived from the delegates self.write
-                # since we're returning a future we cannot break the chunk and
-                # use write to send them, ideally we'd negotiate a bigger frame
-                # size but I'm unsure of the mechanism and if it would even
-                # could negociate at this point or we need to move it elsewhere
-                log.warning('Chunk size exceeds max_frame_size')
-                self._pending_chunk = chunk[
-                    self.conn.remote_settings.max_frame_size:]
-                chunk = chunk[
-                    :self.conn.remote_settings.max_frame_size]
-
-            log.debug("Write_headers: send {} bytes with end_stream={}".format(
-                len(chunk), self.bytes_to_send - len(chunk) <= 0))
-            self._send_data(chunk, self.bytes_to_send - len(chunk) <= 0)
-            self.bytes_to_send -= len(chunk)
-
-        return self.stream.write(self.conn.data_to_send())
+    def _start_stream(self, stream_id, headers, stream_ended, pushed=False):
+        stream = HTTP2Stream(self, stream_id, self.context)
+        stream.stats.pushed = pushed
+        self.streams[stream_id] = stream
+        self._idle_since = None
+        self.streams_opened += 1
+        self.streams_high_water = max(
+            self.streams_high_water, len(self.streams))
+        delegate = self.delegate_factory(stream)
+        future = stream.read_request(headers, delegate, stream_ended)
+        # Register the future on the IOLoop so its errors get logged.
+        self.stream.io_loop.add_future(future, lambda f: f.result())
+        return stream
 
-    def write(self, chunk, callback=None):
-        """Handles additional chunks being flushed.
+    def data_received(self, event):
+        """Handler for DataReceived, hands the data over to its stream.
 
-        For HTTP2 we simply append it to the chunk to be sent in the stream
+        Data for streams no longer open is acknowledged right away so it
+        does not eat up the connection's flow control window.
 
         """
-        if not chunk:
-            log.debug('Write: No chunk')
-            return
+        stream = self.streams.get(event.stream_id)
+        if stream is not None:
+            stream.data_received(event)
+        else:
+            self.acknowledge_received_data(
+                event.flow_controlled_length, event.stream_id)
 
-        log.debug('Write {}'.format(len(chunk)))
-        # if no more data can be sent on this stream hold on for the next window
-        while not self.conn.remote_flow_control_window(self.stream_id):
-            log.debug('Waiting for flow control')
-            return self.wait_for_flow_control()
-
-        # TODO: use the code below to cut off remaining chunk depending
-        # on the remote_flow_control_window
-        # chunk_size = min(
-        #     self.conn.remote_flow_control_window(self.stream_id), 8192
-        # )
-        log.debug('Adding chunk {} - {} = {}'.format(
-            self.bytes_to_send, len(chunk), self.bytes_to_send - len(chunk)))
-        log.debug("write: send_data with end_stream={}".format(
-            self.bytes_to_send - len(chunk) <= 0))
-        self._send_data(chunk, self.bytes_to_send - len(chunk) <= 0)
-        self.bytes_to_send -= len(chunk)
-        # stream.write returns a Future
-        return self.stream.write(self.conn.data_to_send())
-
-    def wait_for_flow_control(self):
-        """Creates a future which will be resolved on the next WindowUpdated.
-
-        """
-        log.debug('Waiting for flow control')
-        # TODO: expand to different stream_ids
-        self._flow_control_future = gen.Future()
-        return self._flow_control_future
+    def acknowledge_received_data(self, size, stream_id):
+        """Opens the inbound flow control windows for data consumed.
 
-    def window_updated(self, event):
-        """Handler for the windowUpdated event. Send all data.
+        """
+        if size and not self.closed:
+            self.conn.acknowledge_received_data(size, stream_id)
+            self.write_to_stream()
+
+    def trailers_received(self, event):
+        """Handler for TrailersReceived, the stream ends right after.
 
         """
-        log.debug('WindowUpdated')
-        # TODO: use for different stream_ids
-        if self._flow_control_future is not None:
-            log.debug('Resolving flow control future')
-            # TODO: does this resolve the Future?
-            self._flow_control_future.set_result(event.delta)
-            self._flow_control_future = None
+        stream = self.streams.get(event.stream_id)
+        if stream is not None:
+            stream.trailers_received(event.headers)
 
     def request_ended(self, event):
         """Handler for StreamEnded.
 
-        Seems H2 wants the data to be sent at this point, but it competes with
-        Tornado's finish mechanism.
+        Hands over to the stream so its delegate can be finished.
 
         """
-        log.debug('Got StreamEnded')
+        stream = self.streams.get(event.stream_id)
+        if stream is not None:
+            stream.request_ended()
+
+    def stream_reset(self, event):
+        """Handler for StreamReset, the client cancelled a stream.
+
+        The stream is aborted, see `HTTP2Stream.abort`.
+
+        """
+        stream = self.streams.get(event.stream_id)
+        if stream is not None:
+            stream.abort(event.error_code)
+
+    def abort_streams(self, error_code=ErrorCodes.CANCEL):
+        """Aborts every stream in progress once nothing more can be sent on
+        the connection, see `HTTP2Stream.abort`.
+
+        """
+        for stream in list(self.streams.values()):
+            stream.abort(error_code)
+
+    def priority_updated(self, event):
+        """Handler for PriorityUpdated, from either a PRIORITY frame or the
+        priority information in a request's HEADERS.
+
+        Priority information of streams closed or refused is ignored, their
+        nodes would never be removed from the tree.
+
+        """
+        stream_id = event.stream_id
+        idle = stream_id not in self.streams
+        if idle and self._was_opened(stream_id):
+            return
+        self.flow_control.prioritize(
+            stream_id, event.depends_on, event.weight, event.exclusive, idle)
+
+    def _was_opened(self, stream_id):
+        if stream_id % 2:
+            return stream_id <= self.conn.highest_inbound_stream_id
+        return stream_id <= self.conn.highest_outbound_stream_id
+
+    def stream_closed(self, stream):
+        """Forgets a stream once its response has been sent or it has
+        been reset.
+
+        """
+        self.flow_control.discard(stream.stream_id)
+        if self.streams.pop(stream.stream_id, None) is not None:
+            self.params.request_budget.release()
+            stats = stream.stats
+            stats.end_time = self.stream.io_loop.time()
+            stats.flow_control_stall = self.flow_control.pop_stall_time(
+                stream.stream_id)
+            self.params.stats_collector.stream_closed(self, stats)
+        self._pushed_streams.discard(stream.stream_id)
+        if not self.streams and self._idle_since is None:
+            self._idle_since = self.stream.io_loop.time()
+        if self._drained_future is not None and not self.streams:
+            self._drained_future.set_result(None)
+            self._drained_future = None
+
+    @gen.coroutine
+    def drain(self, deadline=None):
+        """Closes the connection gracefully.
+
+        A GOAWAY with the last stream accepted so far is sent, telling the
+        client to open new streams on another connection, streams opened
+        regardless are refused. The streams in progress are given until
+        `deadline`, in `IOLoop.time` terms, to finish and are reset if they
+        don't. Then the connection is closed with a final GOAWAY.
+
+        Returns a tuple with the number of streams which finished and the
+        number of streams aborted.
+
+        """
+        if not self.draining:
+            self.draining = True
+            self.last_stream_id = self.conn.highest_inbound_stream_id
+            # H2Connection would refuse to send anything after its GOAWAY,
+            # so this one is serialized here and streams carry on
+            self._extra_output.append(GoAwayFrame(
+                stream_id=0, last_stream_id=self.last_stream_id,
+                error_code=ErrorCodes.NO_ERROR).serialize())
+            self.write_to_stream()
+
+        in_progress = len(self.streams)
+        if self.streams:
+            if self._drained_future is None:
+                self._drained_future = gen.Future()
+            try:
+                if deadline is None:
+                    yield self._drained_future
+                else:
+                    yield gen.with_timeout(deadline, self._drained_future)
+            except gen.TimeoutError:
+                pass
+
+        aborted = len(self.streams)
+        for stream in list(self.streams.values()):
+            stream.reset(ErrorCodes.CANCEL)
+        self.streams_drained += in_progress - aborted
+        self.streams_aborted += aborted
+        log.debug('Drained %d streams, aborted %d',
+                  in_progress - aborted, aborted)
+
+        self.close_connection()
+        try:
+            yield self.write_to_stream()
+        except iostream.StreamClosedError:
+            pass
+        raise gen.Return((in_progress - aborted, aborted))
+
+    def start_timers(self):
+        """Starts the timers watching over the connection.
+
+        The connection is closed with a GOAWAY once it has had no stream
+        open for the `header_timeout` of its parameters. With a
+        `ping_interval` a PING is sent at that interval and the connection
+        is closed if it isn't acknowledged within `ping_timeout`.
+
+        """
+        if self.params.header_timeout:
+            self._set_timeout(
+                'idle', self.params.header_timeout, self._check_idle)
+        if self.params.ping_interval:
+            self._set_timeout(
+                'ping', self.params.ping_interval, self._send_ping)
+
+    def stop_timers(self):
+        for name in list(self._timeouts):
+            self._cancel_timeout(name)
+
+    def _set_timeout(self, name, delay, callback):
+        self._timeouts[name] = self.stream.io_loop.call_later(
+            delay, self._run_timeout, name, callback)
+
+    def _run_timeout(self, name, callback):
+        del self._timeouts[name]
+        callback()
+
+    def _cancel_timeout(self, name):
+        timeout = self._timeouts.pop(name, None)
+        if timeout is not None:
+            self.stream.io_loop.remove_timeout(timeout)
+
+    def _check_idle(self):
+        timeout = self.params.header_timeout
+        idle_since = self._idle_since
+        now = self.stream.io_loop.time()
+        if idle_since is not None and now - idle_since >= timeout:
+            if self.trace:
+                log.debug('Closing connection idle for %.1fs',
+                          now - idle_since)
+            self.stream.io_loop.add_future(
+                self._close_idle(), lambda f: f.result())
+            return
+        self._set_timeout(
+            'idle', timeout - (0 if idle_since is None else now - idle_since),
+            self._check_idle)
+
+    @gen.coroutine
+    def _close_idle(self):
+        yield self.drain()
+        self.stream.close()
+
+    def _send_ping(self):
+        self._set_timeout('ping', self.params.ping_interval, self._send_ping)
+        # Reads are paused while shedding load, the ACK would be late
+        if self._ping_in_flight is not None or self.shedding or self.closed:
+            return
+        self._pings_sent += 1
+        payload = struct.pack('>Q', self._pings_sent)
+        self.conn.ping(payload)
+        self._ping_in_flight = (payload, self.stream.io_loop.time())
+        self._set_timeout(
+            'ping_ack', self.params.ping_timeout, self._ping_timed_out)
+        self.write_to_stream()
+
+    def _ping_timed_out(self):
+        self._ping_in_flight = None
+        if self.shedding:
+            return
+        gen_log.info('No PING ACK from %s in %.1fs, closing the connection',
+                     self.context, self.params.ping_timeout)
+        self.abort_streams()
+        self.stream.close()
+
+    def write_to_stream(self, size_hint=0):
+        """Schedules the data pending in the H2Connection to be written to
+        the TCP stream.
+
+        All the output produced during an IOLoop iteration is coalesced in a
+        single write at the end of it, unless the output buffered, as
+        reported through `size_hint`, reaches the `flush_threshold`.
+
+        Returns a Future resolved when the data has been written.
+
+        """
+        if self._flush_future is None:
+            self._flush_future = gen.Future()
+            self.stream.io_loop.add_callback(self._flush)
+        future = self._flush_future
+        self._pending_output_size += size_hint
+        if self._pending_output_size >= self.params.flush_threshold:
+            self._flush()
+        return future
+
+    def _flush(self):
+        future, self._flush_future = self._flush_future, None
+        if future is None:
+            # Already flushed after reaching the threshold
+            return
+
+        self._pending_output_size = 0
+        data = self.conn.data_to_send()
+        if self._extra_output:
+            data += b''.join(self._extra_output)
+            self._extra_output = []
+        if data:
+            self.flushes += 1
+            self.bytes_written += len(data)
+            self.frames_written += self.frames_sent.feed(data)
+        try:
+            chain_future(self.stream.write(data), future)
+        except iostream.StreamClosedError as e:
+            future.set_exception(e)
+            future.add_done_callback(lambda f: f.exception())
+
+    def _trace_frame(self, direction, frame_type, flags, stream_id, length):
+        frame_log.debug('%s %s %s stream=%d flags=0x%02x length=%d',
+                        self.context, direction, frame_type, stream_id, flags,
+                        length)
+
+    @property
+    def frames_per_flush(self):
+        return float(self.frames_written) / self.flushes if self.flushes else 0
+
+    def stats(self):
+        """Returns a dict with the counters of the connection, its frames
+        sent and received by type, the seconds spent stalled by flow control,
+        the last round trip time measured and the sizes of the HPACK tables.
+
+        """
+        return {
+            'streams_opened': self.streams_opened,
+            'streams_refused': self.streams_refused,
+            'streams_drained': self.streams_drained,
+            'streams_aborted': self.streams_aborted,
+            'streams_high_water': self.streams_high_water,
+            'flushes': self.flushes,
+            'bytes_written': self.bytes_written,
+            'frames_written': self.frames_written,
+            'bytes_read': self.bytes_read,
+            'frames_sent': dict(self.frames_sent.counts),
+            'frames_received': dict(self.frames_received.counts),
+            'stream_stall_time': self.flow_control.stream_stall_time,
+            'connection_stall_time': self.flow_control.connection_stall_time,
+            'rtt': self.rtt,
+            'hpack_encoder_size': _header_table_size(
+                self.conn.encoder.header_table),
+            'hpack_encoder_max_size': self.conn.encoder.header_table_size,
+            'hpack_decoder_size': _header_table_size(
+                self.conn.decoder.header_table),
+            'hpack_decoder_max_size': self.conn.decoder.header_table_size,
+        }
+
+    def window_updated(self, event):
+        """Handler for the WindowUpdated event.
+
+        Resumes the streams waiting for the window to open, all of them if
+        the connection window was updated.
+
+        """
+        self.flow_control.window_updated(event.stream_id)
 
     def receive_data(self, data):
-        return self.conn.receive_data(data)
+        """Feeds `data` read from the TCP stream to H2 and dispatches the
+        resulting events to their handlers, see `event_handlers`.
 
-    def data_to_send(self):
-        return self.conn.data_to_send()
+        Handlers don't wait for the requests to be processed, so all the
+        streams opened by a single read start in the same IOLoop iteration.
 
-    def close_connection(self):
-        self.conn.close_connection()
+        """
+        self.bytes_read += len(data)
+        self.frames_received.feed(data)
+        handlers = self._handlers
+        for event in self.conn.receive_data(data):
+            if self.trace:
+                log.debug('Event: %s', event)
+            handler = handlers.get(event.__class__)
+            if handler is not None:
+                handler(event)
 
-    def _get_response_headers(self):
-        response_headers = [
-            (prefixed_header(header), value)
-            for header, value in self.headers.items()
-        ]
-        response_headers.append((":status", str(self.start_line.code)))
-        return sorted(response_headers)
+    @property
+    def read_size(self):
+        """Number of bytes to read from the TCP stream at once.
 
-    def _send_headers(self):
-        self.conn.send_headers(
-            stream_id=self.stream_id,
-            headers=self._get_response_headers()
-        )
-        log.debug('Headers sent!!')
+        Enough for the whole inbound connection window along with the
+        frames around the data, so a client sending as fast as the window
+        allows is served in a single read, within the stream's buffer limit.
 
-    def _send_data(self, chunk, end_stream=False):
-        self.conn.send_data(
-            stream_id=self.stream_id,
-            data=chunk,
-            end_stream=end_stream
-        )
-        log.debug('Data sent!!')
+        """
+        return max(_MIN_READ_SIZE, min(
+            self.conn.inbound_flow_control_window + _MIN_READ_SIZE,
+            self.stream.max_buffer_size))
 
-    def set_close_callback(self, callback):
-        """Required by RequestHandler init for backwards compatibility.
+    def data_to_send(self):
+        return self.conn.data_to_send()
+
+    @property
+    def closed(self):
+        """Whether a GOAWAY was sent or received, after which H2 refuses
+        to send anything more.
 
         """
-        self._close_callback = stack_context.wrap(callback)
+        return self.conn.state_machine.state == ConnectionState.CLOSED
+
+    def close_connection(self):
+        """Sends a GOAWAY with the last stream processed, if not closed.
+
+        """
+        if not self.closed:
+            self.conn.close_connection(last_stream_id=self.last_stream_id)
 
     def remote_settings_changed(self, event):
         """Handle changes in the remote settings
 
-        TODO: use SettingCodes.MAX_FRAME_SIZE to drive StaticFileHandler's
-        get_content and possibly other settings for large data chunks in write.
+        A new MAX_FRAME_SIZE is picked up by the scheduler and the streams'
+        `max_frame_size` on their next frame.
         """
-        log.debug('Remote settings changed handler')
-        log.info(event)
+        if SettingCodes.INITIAL_WINDOW_SIZE in event.changed_settings:
+            self.flow_control.settings_changed()
 
     def settings_acknowledged(self, event):
         """Handle acknowledgement of settings.
 
         """
-        log.debug('Settings acknowledged')
-        log.info(event)
+
+    def ping_received(self, event):
+        """Handler for PingReceived, H2 has already queued the PING ACK.
+
+        """
+
+    def ping_ack_received(self, event):
+        """Handler for PingAckReceived, measures the round trip time of the
+        PING sent by `_send_ping`.
+
+        """
+        ping = self._ping_in_flight
+        if ping is not None and event.ping_data == ping[0]:
+            self.rtt = self.stream.io_loop.time() - ping[1]
+            self._ping_in_flight = None
+            self._cancel_timeout('ping_ack')
+
+    def connection_terminated(self, event):
+        """Handler for ConnectionTerminated, the client sent a GOAWAY.
+
+        H2 closes the connection on receiving it, so the streams in progress
+        can't be answered and are aborted with the GOAWAY's error code.
+
+        """
+        self.abort_streams(event.error_code)
+
+
+class HTTP2Stream(httputil.HTTPConnection):
+    """A single request/response exchange within an `HTTP2Connection`.
+
+    This is the object exposed to the delegates as `request.connection`,
+    it owns the headers, byte counters and write state of its stream_id.
+
+    """
+
+    def __init__(self, connection, stream_id, context=None):
+        self.connection = connection
+        self.conn = connection.conn
+        self.params = connection.params
+        self.stream_id = stream_id
+        self.context = context
+        self.stats = StreamStats(stream_id, connection.stream.io_loop.time())
+        self.request_headers = None
+        # Trailing headers of the request, if it has any
+        self.request_trailers = None
+        self.headers = None
+        # Bytes of body left to match the response's Content-Length, if any
+        self._expected_content_remaining = None
+        self._compressor = None
+        self._ended = False
+        self._request_ended = False
+        self._close_callback = None
+        self._closed = False
+        # DataReceived events of the request body, None marks its end
+        self._body_queue = Queue()
+        self._max_body_size = (self.params.max_body_size or
+                               connection.stream.max_buffer_size)
+        self._body_timeout = self.params.body_timeout
+
+    @gen.coroutine
+    def read_request(self, headers, delegate, stream_ended=False):
+        if self.params.decompress:
+            delegate = _GzipMessageDelegate(delegate, self.params.chunk_size)
+        need_delegate_close = True
+        self._request_ended = stream_ended
+        try:
+            if headers:
+                with _ExceptionLoggingContext(app_log):
+                    hd = {k: v for k, v in headers}
+                    start_line = httputil.RequestStartLine(
+                        method=hd[':method'], path=hd[':path'],
+                        version='HTTP/2.0')
+                    self.request_headers = httputil.HTTPHeaders(hd)
+                    header_future = delegate.headers_received(
+                        start_line, self.request_headers)
+                    if header_future is not None:
+                        yield header_future
+
+            if not stream_ended:
+                body_future = self._read_body(delegate)
+                if self._body_timeout is not None:
+                    body_future = gen.with_timeout(
+                        self.connection.stream.io_loop.time() +
+                        self._body_timeout,
+                        body_future,
+                        quiet_exceptions=iostream.StreamClosedError)
+                try:
+                    yield body_future
+                except gen.TimeoutError:
+                    gen_log.info("Timeout reading body from %s on stream %s",
+                                 self.context, self.stream_id)
+                    self.reset(ErrorCodes.CANCEL)
+                    raise gen.Return(False)
+
+            need_delegate_close = False
+            with _ExceptionLoggingContext(app_log):
+                delegate.finish()
+        except httputil.HTTPInputError as e:
+            gen_log.info("Malformed HTTP message from %s on stream %s: %s",
+                         self.context, self.stream_id, e)
+            self.reset(ErrorCodes.CANCEL)
+            raise gen.Return(False)
+        except iostream.StreamClosedError:
+            raise gen.Return(False)
+        except gen.Return:
+            raise
+        except Exception as e:
+            # Only this stream fails, the others carry on
+            if not isinstance(e, _QuietException):
+                app_log.error("Uncaught exception on stream %s of %s",
+                              self.stream_id, self.context, exc_info=True)
+            self.reset(ErrorCodes.INTERNAL_ERROR)
+            raise gen.Return(False)
+        finally:
+            if need_delegate_close:
+                with _ExceptionLoggingContext(app_log):
+                    delegate.on_connection_close()
+        raise gen.Return(True)
 
     @gen.coroutine
+    def _read_body(self, delegate):
+        """Feeds the DATA frames of the request to `delegate` as received.
+
+        The data is only acknowledged once the delegate has consumed it, so
+        the client can't send more than the flow control window ahead of a
+        slow delegate.
+
+        """
+        content_length = self.request_headers.get('Content-Length')
+        if (content_length is not None and
+                int(content_length) > self._max_body_size):
+            raise httputil.HTTPInputError("Content-Length too long")
+
+        body_size = 0
+        while True:
+            event = yield self._body_queue.get()
+            if self._closed or self._ended:
+                # Nobody's waiting for the rest of the body
+                raise iostream.StreamClosedError()
+            if event is None:
+                break
+
+            try:
+                body_size += len(event.data)
+                self.stats.bytes_received = body_size
+                if body_size > self._max_body_size:
+                    raise httputil.HTTPInputError("Body too large")
+                if event.data:
+                    with _ExceptionLoggingContext(app_log):
+                        ret = delegate.data_received(event.data)
+                        if ret is not None:
+                            yield ret
+            finally:
+                # Also when failing, it would eat up the connection window
+                self.connection.acknowledge_received_data(
+                    event.flow_controlled_length, self.stream_id)
+
+    def data_received(self, event):
+        self._body_queue.put_nowait(event)
+
+    def trailers_received(self, headers):
+        self.request_trailers = httputil.HTTPHeaders()
+        for name, value in headers:
+            self.request_trailers.add(name, value)
+
+    def request_ended(self):
+        self._request_ended = True
+        self._body_queue.put_nowait(None)
+
+    def set_body_timeout(self, timeout):
+        """Sets the body timeout for a single request.
+
+        Overrides the value from `HTTP2ConnectionParameters`.
+        """
+        self._body_timeout = timeout
+
+    def set_max_body_size(self, max_body_size):
+        """Sets the body size limit for a single request.
+
+        Overrides the value from `HTTP2ConnectionParameters`.
+        """
+        self._max_body_size = max_body_size
+
+    def reset(self, error_code=ErrorCodes.NO_ERROR):
+        """Resets the stream, discarding any data waiting to be sent.
+
+        Data received and not yet consumed is acknowledged so it doesn't eat
+        up the connection window.
+
+        """
+        if self._closed:
+            return
+        log.debug('Resetting stream %d with %s', self.stream_id, error_code)
+        self.conn.reset_stream(self.stream_id, error_code)
+        self.abort(error_code)
+        self.connection.write_to_stream()
+
+    def abort(self, error_code):
+        """Closes the stream without sending anything, after it was reset
+        by either side or the connection was closed or lost.
+
+        Data waiting to be sent is discarded, failing the Futures of the
+        writes and flushes in progress with StreamClosedError. The request's
+        delegate gets `on_connection_close` if its body was being read,
+        and the close callback is run, so a handler can stop working on a
+        response nobody will read.
+
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.stats.reset = error_code
+        self.connection.flow_control.discard(self.stream_id)
+        self.connection.stream_closed(self)
+        while self._body_queue.qsize():
+            event = self._body_queue.get_nowait()
+            if event is not None:
+                self.connection.acknowledge_received_data(
+                    event.flow_controlled_length, self.stream_id)
+        # Wake up the body reader, if any, so it stops
+        self._body_queue.put_nowait(None)
+        if self._close_callback is not None:
+            callback, self._close_callback = self._close_callback, None
+            self.connection.stream.io_loop.add_callback(callback)
+
+    @property
+    def max_frame_size(self):
+        """Largest DATA frame payload the client currently accepts.
+
+        """
+        return self.conn.max_outbound_frame_size
+
+    @property
+    def flow_control_window(self):
+        """Bytes that can be sent on this stream right now, the minimum of
+        the stream's and the connection's flow control windows.
+
+        """
+        try:
+            return self.conn.local_flow_control_window(self.stream_id)
+        except ProtocolError:
+            # The stream is closed
+            return 0
+
+    def push(self, path, headers=None):
+        """Pushes the response for a GET on `path` to the client.
+
+        Available to handlers as ``self.request.connection.push``, it should
+        be called before the response is finished. Returns the promised
+        `HTTP2Stream` or None if the resource could not be pushed.
+
+        """
+        return self.connection.push(self, path, headers)
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        """Sends the response headers right away, along with the first chunk
+        of the body if any.
+
+        Unless the response can't have a body the stream is left open for
+        the rest of it to be sent through `write` until `finish` is called,
+        so the length of the response needn't be known in advance.
+
+        """
+        if self.connection.trace:
+            log.debug('Write headers on stream %d: %s %s', self.stream_id,
+                      start_line.code, list(headers.get_all()))
+        if self._closed:
+            return _stream_closed_future()
+
+        self.start_line = start_line
+        self.stats.status = start_line.code
+        self.stats.headers_time = self.connection.stream.io_loop.time()
+
+        self.headers = headers
+        if 'Content-Length' in headers:
+            self._expected_content_remaining = int(headers['Content-Length'])
+
+        if not chunk and self._is_bodiless(start_line):
+            # The response is complete with its headers, as for 304s
+            self._send_headers(end_stream=True)
+            self._end_response()
+            self.connection.flow_control.discard(self.stream_id)
+            return self._add_callback(
+                self.connection.write_to_stream(), callback)
+
+        if self.params.compress_response:
+            self._compressor = self._get_compressor()
+
+        self._send_headers()
+
+        if chunk:
+            future = self._send_data(chunk)
+        else:
+            future = self.connection.write_to_stream()
+        return self._add_callback(future, callback)
+
+    def _is_bodiless(self, start_line):
+        """Whether the response can't have a body, RFC 7230 3.3.3.
+
+        """
+        return (
+            start_line.code in (204, 304) or
+            100 <= start_line.code < 200 or
+            self.request_headers.get(':method') == 'HEAD' or
+            self._expected_content_remaining == 0)
+
+    def _get_compressor(self):
+        """Returns the compressor of the response body, or None if it
+        shouldn't be compressed.
+
+        The response headers are updated to match.
+
+        """
+        headers = self.headers
+        if ('Content-Encoding' in headers or 'Content-Range' in headers or
+                not is_compressible(headers.get('Content-Type', ''))):
+            return None
+
+        vary = headers.get('Vary')
+        if vary is None:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            headers['Vary'] = vary + ', Accept-Encoding'
+
+        if (self._expected_content_remaining is not None and
+                self._expected_content_remaining < MIN_LENGTH):
+            return None
+        encoding = negotiate_encoding(
+            self.request_headers.get('Accept-Encoding', ''), COMPRESSORS)
+        if encoding is None:
+            return None
+
+        log.debug('Compressing response on stream %d with %s',
+                  self.stream_id, encoding)
+        headers['Content-Encoding'] = encoding
+        # The compressed length is unknown until finish()
+        headers.pop('Content-Length', None)
+        self._expected_content_remaining = None
+        return COMPRESSORS[encoding](self.params.compression_level)
+
+    def write(self, chunk, callback=None):
+        """Handles additional chunks being flushed.
+
+        `chunk` may be bytes or a `memoryview`, neither is copied. The chunk
+        is handed over to the connection's flow control scheduler
+        which splits it in frames as the flow control windows allow, the
+        returned Future resolves once the whole chunk has been written.
+
+        """
+        if self._closed or self._ended:
+            return _stream_closed_future()
+        if not chunk:
+            # Resolves once the data written before has been sent
+            return self._add_callback(
+                self.connection.flow_control.send_data(self.stream_id, b''),
+                callback)
+
+        if self.connection.trace:
+            log.debug('Write %d bytes on stream %d',
+                      len(chunk), self.stream_id)
+        return self._add_callback(self._send_data(chunk), callback)
+
+    def _add_callback(self, future, callback):
+        """Runs `callback`, if any, once the write of `future` succeeds.
+
+        """
+        if callback is not None:
+            callback = stack_context.wrap(callback)
+
+            def on_written(future):
+                if future.exception() is None:
+                    callback()
+            self.connection.stream.io_loop.add_future(future, on_written)
+        return future
+
+    def _get_response_headers(self):
+        return h2_headers(
+            [(b':status', str(self.start_line.code).encode())], self.headers,
+            self.params.never_indexed_headers)
+
+    def _send_headers(self, end_stream=False):
+        self.conn.send_headers(
+            stream_id=self.stream_id,
+            headers=self._get_response_headers(),
+            end_stream=end_stream
+        )
+
+    def _send_data(self, chunk):
+        if self._expected_content_remaining is not None:
+            self._expected_content_remaining -= len(chunk)
+            if self._expected_content_remaining < 0:
+                self.reset(ErrorCodes.INTERNAL_ERROR)
+                raise httputil.HTTPOutputError(
+                    "Tried to write more data than Content-Length")
+        if self._compressor is not None:
+            chunk = self._compressor.compress(chunk)
+        future = self.connection.flow_control.send_data(self.stream_id, chunk)
+        if not self.stats.bytes_sent:
+            self.connection.stream.io_loop.add_future(
+                future, self._first_chunk_written)
+        self.stats.bytes_sent += len(chunk)
+        return future
+
+    def _first_chunk_written(self, future):
+        if future.exception() is None and self.stats.first_byte_time is None:
+            self.stats.first_byte_time = self.connection.stream.io_loop.time()
+
+    def set_close_callback(self, callback):
+        """Sets a callback run if the stream is aborted before its response
+        is complete, see `abort`.
+
+        `.RequestHandler` sets its ``on_connection_close`` and clears it on
+        ``finish``.
+
+        """
+        self._close_callback = stack_context.wrap(callback)
+
     def finish(self):
         """Hook into Tornado's handlers for finishing a request.
 
+        Ends the stream after the data written so far, on its last DATA frame
+        if still queued or an empty one otherwise. Any data still waiting for
+        flow control is sent by the connection's scheduler once the window
+        opens, the stream is closed after that.
+
+        A response finished before the request body was fully received, an
+        early 413 for instance, stops the body reader and is followed by a
+        RST_STREAM with NO_ERROR so the client stops sending, RFC 7540 8.1.
+
         """
-        # TODO: this is less than elegant but covers the case where the
-        # delegate tries to send a chunk larger than the current max_frame_size
-        # in `write_headers` we cannot handle it there since we need to return
-        # a Future so we handle it here.
-        if hasattr(self, '_pending_chunk'):
-            log.warning('Pending data in finish')
-            while self.bytes_to_send > 0:
-                chunk = self._pending_chunk[
-                    :self.conn.remote_settings.max_frame_size]
-                self._pending_chunk = self._pending_chunk[
-                    self.conn.remote_settings.max_frame_size:]
-                self.bytes_to_send -= len(chunk)
-                self._send_data(chunk, self.bytes_to_send <= 0)
-                yield self.stream.write(self.conn.data_to_send())
+        if not (self._closed or self._ended):
+            if self._expected_content_remaining:
+                remaining = self._expected_content_remaining
+                self.reset(ErrorCodes.INTERNAL_ERROR)
+                raise httputil.HTTPOutputError(
+                    "Tried to write %d bytes less than Content-Length" %
+                    remaining)
+            tail = b''
+            if self._compressor is not None:
+                tail = self._compressor.finish()
+                self._compressor = None
+            future = self.connection.flow_control.send_data(
+                self.stream_id, tail, end_stream=True)
+            self._end_response()
+            # The stream is in progress until its response is fully sent
+            self.connection.stream.io_loop.add_future(
+                future, lambda f: self._response_sent())
+            return
+        self._response_sent()
+
+    def _end_response(self):
+        self._ended = True
+        if not self._request_ended:
+            # Wake up the body reader so it stops
+            self._body_queue.put_nowait(None)
 
-        raise gen.Return()
+    def _response_sent(self):
+        if not self._request_ended:
+            self.reset(ErrorCodes.NO_ERROR)
+        self.connection.stream_closed(self)
 
 
 class HTTP2ServerConnection(HTTP1ServerConnection):
@@ -248,47 +1338,67 @@ class HTTP2ServerConnection(HTTP1ServerConnection):
 
     """
 
+    #: The `HTTP2Connection` subclass handling the connection
+    connection_class = HTTP2Connection
+
+    def __init__(self, stream, params=None, context=None,
+                 upgrade_request=None):
+        """
+        :arg upgrade_request: for a connection upgraded from HTTP/1.1, the
+            start line and headers of the request which asked for it.
+        """
+        super(HTTP2ServerConnection, self).__init__(stream, params, context)
+        self.upgrade_request = upgrade_request
+
     @gen.coroutine
     def _server_request_loop(self, delegate):
-        log.debug(
-            "HTTP2ServerConnection loop with delegate {}".format(delegate))
-        conn = HTTP2Connection(self.stream)
-        yield conn.initiate_connection()
-        request_delegate = delegate.start_request(self, conn)
+        log.debug('HTTP2ServerConnection loop with delegate %s', delegate)
+        conn = self.h2_connection = self.connection_class(
+            self.stream, self.params, self.context,
+            lambda stream: delegate.start_request(self, stream))
+        # Frames are coalesced in HTTP2Connection, so Nagle's algorithm only
+        # delays them, stalling uploads on every WINDOW_UPDATE
+        self.stream.set_nodelay(True)
+        try:
+            yield conn.initiate_connection(self.upgrade_request)
+            conn.start_timers()
 
-        while True:
-            try:
-                data = yield self.stream.read_bytes(65535, partial=True)
-            except iostream.StreamClosedError:
-                conn.close_connection()
-                break
+            while True:
+                data = yield self.stream.read_bytes(
+                    conn.read_size, partial=True)
+                if not data:
+                    continue
+
+                try:
+                    conn.receive_data(data)
+                except ProtocolError as e:
+                    # H2 has queued a GOAWAY with the error
+                    gen_log.info('Protocol error from %s: %s',
+                                 self.context, e)
+                yield conn.write_to_stream()
+                if conn.closed:
+                    # A GOAWAY was received, or sent on a protocol error
+                    self.stream.close()
+                    break
+                if conn.shedding:
+                    yield conn.wait_for_budget()
+                    yield conn.write_to_stream()
+        except iostream.StreamClosedError:
+            conn.close_connection()
+        finally:
+            conn.stop_timers()
+            conn.abort_streams()
+            self.params.stats_collector.connection_closed(conn, conn.stats())
+            delegate.on_close(self)
 
-            if not data:
-                log.debug('No data read from TCP stream')
-                continue
-
-            events = conn.receive_data(data)
-            log.debug('Read events')
-            for event in events:
-                log.debug("EVENT: {}".format(event))
-                if isinstance(event, h2.events.RequestReceived):
-                    yield conn.request_received(
-                        event, request_delegate, data)
-                # elif isinstance(event, h2.events.DataReceived):
-                #     conn.reset_stream(event.stream_id)
-                elif isinstance(event, h2.events.StreamEnded):
-                    # TODO: we need to properly handle a StreamEnded
-                    conn.request_ended(event)
-                elif isinstance(event, h2.events.RemoteSettingsChanged):
-                    conn.remote_settings_changed(event)
-                elif isinstance(event, h2.events.SettingsAcknowledged):
-                    conn.settings_acknowledged(event)
-                elif isinstance(event, h2.events.WindowUpdated):
-                    conn.window_updated(event)
-                elif isinstance(event, h2.events.ConnectionTerminated):
-                    conn.close_connection()
-
-            buffer = conn.data_to_send()
-            if buffer:
-                log.debug('Writing to TCP stream: {}'.format(buffer))
-                yield self.stream.write(buffer)
+    @gen.coroutine
+    def drain(self, deadline=None):
+        """Closes the connection gracefully, see `HTTP2Connection.drain`.
+
+        Returns a `.Future` resolved once the serving loop has exited with
+        the number of streams which finished and were aborted.
+
+        """
+        result = yield self.h2_connection.drain(deadline)
+        yield self.close()
+        raise gen.Return(result)
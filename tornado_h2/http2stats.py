@@ -0,0 +1,215 @@
+"""
+Measurements of HTTP/2 connections and streams.
+
+"""
+
+import collections
+
+
+FRAME_TYPES = {
+    0x0: 'DATA',
+    0x1: 'HEADERS',
+    0x2: 'PRIORITY',
+    0x3: 'RST_STREAM',
+    0x4: 'SETTINGS',
+    0x5: 'PUSH_PROMISE',
+    0x6: 'PING',
+    0x7: 'GOAWAY',
+    0x8: 'WINDOW_UPDATE',
+    0x9: 'CONTINUATION',
+}
+
+#: Length of the client connection preface, which isn't a frame
+CLIENT_PREFACE_LENGTH = 24
+
+
+class FrameCounter(object):
+    """Counts the frames by type in a stream of bytes fed in pieces of any
+    size, only the 9 bytes frame headers are looked at.
+
+    """
+
+    def __init__(self, skip=0, on_frame=None):
+        """
+        :arg int skip: bytes to ignore at the start of the stream, as the
+            client connection preface.
+        :arg on_frame: optional callable called with the type, flags,
+            stream id and length of every frame, for tracing.
+        """
+        self.counts = collections.Counter()
+        self.on_frame = on_frame
+        self._skip = skip
+        self._header = b''
+
+    def feed(self, data):
+        """Counts the frames starting in `data`, returns how many.
+
+        """
+        frames = 0
+        offset = 0
+        size = len(data)
+        while offset < size:
+            if self._skip:
+                skipped = min(self._skip, size - offset)
+                self._skip -= skipped
+                offset += skipped
+                continue
+            needed = 9 - len(self._header)
+            self._header += data[offset:offset + needed]
+            offset += needed
+            if len(self._header) == 9:
+                # 24 bits length, 8 bits type, 8 bits flags, 32 bits id
+                header = self._header
+                self._skip = int.from_bytes(header[:3], 'big')
+                frame_type = FRAME_TYPES.get(header[3], 'UNKNOWN')
+                self.counts[frame_type] += 1
+                if self.on_frame is not None:
+                    self.on_frame(
+                        frame_type, header[4],
+                        int.from_bytes(header[5:], 'big') & 0x7fffffff,
+                        self._skip)
+                self._header = b''
+                frames += 1
+        return frames
+
+
+class StreamStats(object):
+    """Timings and sizes of a single stream.
+
+    Times are in `IOLoop.time` terms, those of events which didn't happen
+    are None, like `first_byte_time` for responses without a body.
+
+    """
+
+    __slots__ = (
+        'stream_id', 'pushed', 'status', 'start_time', 'headers_time',
+        'first_byte_time', 'end_time', 'bytes_received', 'bytes_sent',
+        'flow_control_stall', 'reset')
+
+    def __init__(self, stream_id, start_time, pushed=False):
+        self.stream_id = stream_id
+        self.pushed = pushed
+        self.status = None
+        #: The request's HEADERS were received
+        self.start_time = start_time
+        #: The response's HEADERS were sent
+        self.headers_time = None
+        #: The first chunk of the response body was written to the socket
+        self.first_byte_time = None
+        #: The stream was closed
+        self.end_time = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        #: Seconds with data to send but no flow control window to send it
+        self.flow_control_stall = 0.0
+        #: Error code the stream was aborted with, if it was: that of the
+        #: RST_STREAM sent or received or of the client's GOAWAY, CANCEL
+        #: when the connection was lost
+        self.reset = None
+
+    def _since_start(self, time):
+        return None if time is None else time - self.start_time
+
+    @property
+    def time_to_headers(self):
+        return self._since_start(self.headers_time)
+
+    @property
+    def time_to_first_byte(self):
+        return self._since_start(self.first_byte_time)
+
+    @property
+    def duration(self):
+        return self._since_start(self.end_time)
+
+
+class StatsCollector(object):
+    """Receives the measurements of the connections of an `HTTP2Server`
+    passed it as `stats_collector`.
+
+    This base class ignores them all, subclasses override the methods they
+    are interested in to forward the measurements to a monitoring system.
+    Methods run on the IOLoop and should return quickly.
+
+    """
+
+    def connection_opened(self, connection):
+        """Called with each new `HTTP2Connection`.
+
+        """
+
+    def stream_closed(self, connection, stream_stats):
+        """Called with the `StreamStats` of each stream as it's closed.
+
+        """
+
+    def connection_closed(self, connection, stats):
+        """Called with the result of `HTTP2Connection.stats` as the
+        connection closes.
+
+        """
+
+
+class SummaryStatsCollector(StatsCollector):
+    """Keeps totals and maxima of the measurements of all connections.
+
+    """
+
+    stream_timings = ('time_to_headers', 'time_to_first_byte', 'duration')
+
+    def __init__(self):
+        self.connections = 0
+        self.streams = 0
+        self.streams_reset = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.flow_control_stall = 0.0
+        self.streams_high_water = 0
+        self.frames_sent = collections.Counter()
+        self.frames_received = collections.Counter()
+        # Count, total and maximum of each timing
+        self.timings = {
+            name: [0, 0.0, 0.0] for name in self.stream_timings}
+
+    def stream_closed(self, connection, stream_stats):
+        self.streams += 1
+        if stream_stats.reset is not None:
+            self.streams_reset += 1
+        self.bytes_received += stream_stats.bytes_received
+        self.bytes_sent += stream_stats.bytes_sent
+        self.flow_control_stall += stream_stats.flow_control_stall
+        for name in self.stream_timings:
+            value = getattr(stream_stats, name)
+            if value is not None:
+                timing = self.timings[name]
+                timing[0] += 1
+                timing[1] += value
+                timing[2] = max(timing[2], value)
+
+    def connection_closed(self, connection, stats):
+        self.connections += 1
+        self.streams_high_water = max(
+            self.streams_high_water, stats['streams_high_water'])
+        self.frames_sent.update(stats['frames_sent'])
+        self.frames_received.update(stats['frames_received'])
+
+    def summary(self):
+        """Returns a dict with the totals, and the mean and maximum of each
+        stream timing.
+
+        """
+        summary = {
+            'connections': self.connections,
+            'streams': self.streams,
+            'streams_reset': self.streams_reset,
+            'bytes_received': self.bytes_received,
+            'bytes_sent': self.bytes_sent,
+            'flow_control_stall': self.flow_control_stall,
+            'streams_high_water': self.streams_high_water,
+            'frames_sent': dict(self.frames_sent),
+            'frames_received': dict(self.frames_received),
+        }
+        for name, (count, total, maximum) in self.timings.items():
+            summary[name + '_mean'] = total / count if count else None
+            summary[name + '_max'] = maximum if count else None
+        return summary